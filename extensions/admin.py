@@ -1,4 +1,5 @@
 import sys
+import datetime
 import itertools
 import traceback
 
@@ -103,6 +104,74 @@ class Admin(JishakuBase, metaclass=GroupCogMeta, command_parent=admin):
         for page in paginator.pages:
             await ctx.send(page)
 
+    @commands.command(name="metrics")
+    async def jsk_metrics(self, ctx: commands.Context, sort_by: str = "count"):
+        """Shows per-command invocation counts, errors, latency and DB calls.
+        Sort by count, errors, mean, p95 or queries. Times are in milliseconds, queries are per invocation."""
+
+        sort_keys = {
+            "count": lambda k: k[1].count,
+            "errors": lambda k: k[1].errors,
+            "mean": lambda k: k[1].latency["total"].mean,
+            "p95": lambda k: k[1].latency["total"].quantile(0.95),
+            "queries": lambda k: k[1].waits_per_invocation("db")
+        }
+
+        if sort_by not in sort_keys:
+            raise commands.BadArgument
+
+        stats = sorted(self.bot.metrics.commands.items(), key=sort_keys[sort_by], reverse=True)
+        if not stats:
+            return await ctx.send("No commands have been used yet.")
+
+        paginator = WrappedPaginator(prefix="```", suffix="```")
+        paginator.add_line(
+            f"{'command':<20} {'count':>6} {'errors':>6} {'mean':>8} {'p95':>8} "
+            f"{'db':>8} {'exec':>8} {'send':>8} {'queries':>7}"
+        )
+
+        for name, command_stats in stats:
+            latency = command_stats.latency
+            paginator.add_line(
+                f"{name[:20]:<20} {command_stats.count:>6} {command_stats.errors:>6} "
+                f"{latency['total'].mean * 1000:>8.1f} {latency['total'].quantile(0.95) * 1000:>8.1f} "
+                f"{latency['db'].mean * 1000:>8.1f} {latency['executor'].mean * 1000:>8.1f} "
+                f"{latency['send'].mean * 1000:>8.1f} {command_stats.waits_per_invocation('db'):>7.1f}"
+            )
+
+        for page in paginator.pages:
+            await ctx.send(page)
+
+    @commands.command(name="lag")
+    async def jsk_lag(self, ctx: commands.Context, count: int = 5):
+        """Shows event loop lag percentiles, and the most recent times that the loop woke up late.
+        For each stall, shows how late it was, the command that was running (if any) and where it was stuck."""
+
+        monitor = self.bot.lag_monitor
+        paginator = WrappedPaginator(prefix="", suffix="")
+        paginator.add_line(
+            f"Loop lag over the last {len(monitor.samples)} samples: "
+            f"p50 {monitor.percentile(0.5) * 1000:.1f}ms, p95 {monitor.percentile(0.95) * 1000:.1f}ms, "
+            f"p99 {monitor.percentile(0.99) * 1000:.1f}ms, max {monitor.percentile(1) * 1000:.1f}ms.",
+            empty=True
+        )
+
+        stalls = monitor.recent_stalls(count)
+        if not stalls:
+            paginator.add_line(f"The loop hasn't woken up more than {monitor.threshold * 1000:.0f}ms late yet.")
+
+        for stall in reversed(stalls):
+            when = datetime.datetime.fromtimestamp(stall["when"]).strftime("%H:%M:%S")
+            where = "".join(traceback.format_list(stall["stack"][-4:])) or "(not caught in time)\n"
+            paginator.add_line(
+                f"\N{WARNING SIGN} {when}: {stall['lag'] * 1000:.0f}ms loop lag "
+                f"in `{stall['command'] or 'no command'}`\n```py\n{where}```",
+                empty=True
+            )
+
+        for page in paginator.pages:
+            await ctx.send(page)
+
 
 def setup(bot):
     bot.add_cog(Admin(bot))
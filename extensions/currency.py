@@ -5,15 +5,15 @@ import random
 
 from collections import defaultdict
 from enum import Enum
+from typing import Optional
 
 
 import discord
-import toml
 import bigbeans
 import pendulum
 
 from discord.ext import commands, menus
-from extensions.models import exceptions, menuclasses
+from extensions.models import exceptions, menuclasses, itemclasses
 
 # True represents a "dark" outcome, while False indicates a "light" outcome
 VALID_DISPOSITION_MAPPING = {
@@ -93,10 +93,7 @@ MOON_WHEEL_INFO = {
 }
 
 
-with open("extensions/items.toml") as tomlfile:
-    item_data = toml.load(tomlfile)
-    ITEM_MAPPING = defaultdict(lambda: item_data["item 404"])
-    ITEM_MAPPING.update(item_data)
+ITEMS = itemclasses.ItemCatalog.load("extensions/items.toml")
 
 
 class ActionOutcome(Enum):
@@ -118,21 +115,19 @@ class Currency(commands.Cog, name="Currency & Items"):
 
         return emoji_time_display, time_printable
 
-    async def add_currency(self, user_id: int, amount: int):
-        current = await self.db["currency"].find_one(user_id=user_id)
-        if current:
-            await self.db["currency"].upsert(["user_id"], user_id=user_id, amount=current["amount"] + amount)
-        else:
-            await self.db["currency"].insert(user_id=user_id, amount=amount)
+    async def add_currency(self, user_id: int, amount: int, guild_id: Optional[int] = None) -> int:
+        return await self.bot.get_cog("Database").currency_add(user_id, amount, guild_id)
 
     async def before_ready(self):
         self.db = self.bot.db  # type: bigbeans.databean.Databean
+        await self.bot.get_cog("Database").weapon_strength_sync({
+            item.name: item.tool.strength for item in ITEMS.tools_by_type.get("weapon", ())
+        })
 
     @commands.is_owner()
     @commands.command()
     async def giveme(self, ctx, amount: int, *, item):
-        for _ in range(amount):
-            await ctx.cogs["Database"].inventory_add(user_id=ctx.author.id, name=item, durability=100)
+        await ctx.cogs["Database"].inventory_add_many(ctx.author.id, {item: (amount, ITEMS[item].durability)})
 
     @commands.command(aliases=["$"])
     async def balance(self, ctx, *, who: discord.Member = None):
@@ -142,8 +137,7 @@ class Currency(commands.Cog, name="Currency & Items"):
 
         # get user, amount and then build embed
         who = who or ctx.author
-        currency = await self.db["currency"].find_one(user_id=who.id)
-        amount_owned = currency["amount"] if currency else 0
+        amount_owned = await ctx.cogs["Database"].currency_balance(who.id)
         embed = discord.Embed(title="Currency", color=16202876)
         embed.set_author(name=str(who), icon_url=who.avatar_url)
 
@@ -160,6 +154,41 @@ class Currency(commands.Cog, name="Currency & Items"):
 
         await ctx.send(embed=embed)
 
+    @commands.command(aliases=["lb", "richest"])
+    async def leaderboard(self, ctx, scope: str = "server"):
+        """
+        See who has the most currency.
+        Use "server" to see people that have played here, or "global" to see everyone.
+        """
+
+        if scope.lower() not in ("server", "global"):
+            raise commands.BadArgument
+
+        leaderboards = ctx.cogs["Database"].leaderboards
+        if not leaderboards.reconciled:
+            return await ctx.send("The leaderboard is still being put together! Try again in a minute.")
+
+        if scope.lower() == "global" or ctx.guild is None:
+            ranking, title = leaderboards.everyone, "Global leaderboard"
+        else:
+            ranking, title = leaderboards.guild(ctx.guild.id), f"{ctx.guild.name} leaderboard"
+
+        lines = []
+        for position, (user_id, amount) in enumerate(ranking.top(10), start=1):
+            user = self.bot.get_user(user_id)
+            lines.append(f"**{position}.** {user or f'Unknown user ({user_id})'} - {amount} {COIN}")
+
+        embed = discord.Embed(title=title, color=16202876)
+        embed.description = "\n".join(lines) or "Nobody here has any currency yet!"
+
+        rank = ranking.rank(ctx.author.id)
+        if rank is None:
+            embed.set_footer(text="You're not on this leaderboard yet.")
+        else:
+            embed.set_footer(text=f"You're #{rank} out of {len(ranking)}.")
+
+        await ctx.send(embed=embed)
+
     @commands.command()
     async def daily(self, ctx, *, disposition: str):
         """
@@ -212,7 +241,7 @@ class Currency(commands.Cog, name="Currency & Items"):
         embed.set_footer(text="You can play again tomorrow.")
 
         # give them their money and send
-        await self.add_currency(ctx.author.id, resulting_value)
+        await self.add_currency(ctx.author.id, resulting_value, ctx.guild.id if ctx.guild else None)
         await ctx.cogs["Database"].cooldown_set(ctx.author.id, "daily")
         await ctx.send(embed=embed)
 
@@ -223,17 +252,16 @@ class Currency(commands.Cog, name="Currency & Items"):
         """
 
         # fetch items; if they don't have any, don't bother
-        results = await self.db["inventory"].find(user_id=ctx.author.id)
-        if not results:
+        sorted_results = await ctx.cogs["Database"].inventory_counts(ctx.author.id)
+        if not sorted_results:
             await ctx.send("You don't have any items!")
         else:
-            sorted_results = collections.Counter([item["name"] for item in sorted(results, key=lambda k: k["name"])])
             embeds = []
             for name, count in sorted_results.items():
-                item_details = ITEM_MAPPING[name]
+                item_details = ITEMS[name]
                 embed = discord.Embed(
                     title=name,
-                    description=item_details["description"] or "(No extended description)", color=16202876
+                    description=item_details.description or "(No extended description)", color=16202876
                 )
 
                 # build embed content
@@ -242,7 +270,7 @@ class Currency(commands.Cog, name="Currency & Items"):
                     name="Quantity",
                     value=(
                         f"You have {count}x of this item, worth a total of "
-                        f"{count * (item_details['value'] or 0)} {COIN} ({item_details['value'] or 0} {COIN} each) "),
+                        f"{count * item_details.value} {COIN} ({item_details.value} {COIN} each) "),
                     inline=False
                 )
 
@@ -260,12 +288,11 @@ class Currency(commands.Cog, name="Currency & Items"):
         """
 
         # fetch items; if they don't have any, don't bother
-        results = await self.db["inventory"].find(user_id=ctx.author.id)
-        if not results:
+        sorted_results = await ctx.cogs["Database"].inventory_counts(ctx.author.id)
+        if not sorted_results:
             await ctx.send("You don't have any items!")
         else:
-            # sort alphabetically by item name, then build data for our menu
-            sorted_results = collections.Counter([item["name"] for item in sorted(results, key=lambda k: k["name"])])
+            # counts come back sorted alphabetically by item name, so just build data for our menu
             page_data = [f"{count}x **{name.capitalize()}**" for name, count in sorted_results.items()]
             pages = menuclasses.ListPageMenu(
                 page_data, 10, menuclasses.title_page_number_formatter("Inventory")
@@ -282,13 +309,11 @@ class Currency(commands.Cog, name="Currency & Items"):
         Go in search of valuables.
         """
 
-        await ctx.cogs["Database"].game_advance_time(ctx.author.id, 20)
-        current_time = (await ctx.db["game_time"].find_one(user_id=ctx.author.id))["minutes"]
+        current_time = await ctx.cogs["Database"].game_advance_time(ctx.author.id, 20)
         emoji_time_display, time_printable = self.calculate_time_details(current_time)
 
         # appease the linter
         strongest_weapon = None
-        strongest_weapon_db_entry = None
         durability_lost = None
         bonus = 0
         outcome = ActionOutcome.NORMAL
@@ -297,31 +322,13 @@ class Currency(commands.Cog, name="Currency & Items"):
         if (0 < current_time < 330) or (1110 < current_time < 1440):
             if random.randint(1, 3) == 3:
                 outcome = ActionOutcome.ATTACKED
-                # get weapons, check if we can defeat this monster
-                # i would've liked to do this differently, but can't think of a better method right now
-                # first we narrow down to the distinct items that the user owns
-                distinct_owned_items = await self.db.fetch_query(
-                    f"SELECT DISTINCT on (name) name, user_id FROM inventory WHERE user_id = {ctx.author.id}"
-                )
-
-                # now that we have owned items from the db, we get all items that are tools
-                # i would want to make this a dict, but it makes the next bits annoying - perhaps there's a better way?
-                tools = [(key, value) for key, value in ITEM_MAPPING.items() if value.get("tool", None)]
-                # filter that down to all weapons
-                weapons = list(filter(lambda k: k[1]["tool"]["tool_type"] == "weapon", tools))
-                # now we filter weapons down to weapons we actually have
-                distinct_names = [item["name"] for item in distinct_owned_items]
-                owned_weapons = [weapon for weapon in weapons if weapon[0] in distinct_names]
-                # get the strongest if we own any weapons
-                if owned_weapons:
-                    strongest_weapon = sorted(owned_weapons, key=lambda k: k[1]["tool"]["strength"], reverse=True)[0]
+                # check if the strongest weapon they have (if any) can defeat this monster
+                strongest_weapon = await ctx.cogs["Database"].inventory_strongest_weapon(ctx.author.id)
+                if strongest_weapon:
                     roll = random.randint(1, 2)
-                    if strongest_weapon[1]["tool"]["strength"] >= roll:
+                    if strongest_weapon["strength"] >= roll:
                         outcome = ActionOutcome.VICTORIOUS
                         bonus = random.randint(6, 13)
-                        strongest_weapon_db_entry = await self.db["inventory"].find_one(
-                            user_id=ctx.author.id, name=strongest_weapon[0]
-                        )
 
         # in the future i'll do this differently, for now it'll look like this
         gathered = random.choices(
@@ -348,19 +355,13 @@ class Currency(commands.Cog, name="Currency & Items"):
             )
         elif outcome == ActionOutcome.VICTORIOUS:
             # maybe get rid of the weapon
-            new_durability = strongest_weapon_db_entry["durability"] - durability_lost
-            if new_durability <= 0:
-                await self.db["inventory"].delete(_id=strongest_weapon_db_entry["_id"])
-            else:
-                await self.db["inventory"].upsert(
-                    ["_id"], _id=strongest_weapon_db_entry["_id"], durability=new_durability
-                )
+            await ctx.cogs["Database"].inventory_wear_item(strongest_weapon["_id"], durability_lost)
 
             embed.description = (
                 f"{' '.join(list(emoji_time_display)[:5])}\n"
                 f"The current time is {time_printable}. You spent 20 minutes forag- \n\n"
                 "**You were attacked by a beast of the night!** - but it was no match for you!\n"
-                f"Your weapon **{strongest_weapon_db_entry['name']}** (ID ``{strongest_weapon_db_entry['_id']}``) "
+                f"Your weapon **{strongest_weapon['name']}** (ID ``{strongest_weapon['_id']}``) "
                 f"lost {durability_lost} point(s) of durability, and you gained:\n\n"
                 "{0}".format("\n".join(obtained))
             )
@@ -374,9 +375,9 @@ class Currency(commands.Cog, name="Currency & Items"):
         # only award items if they didn't get attacked
         if outcome != ActionOutcome.ATTACKED:
             # give the user their items
-            for name, count in kept.items():
-                for _ in range(count):  # TODO: move this to an execute many, will chug later on otherwise
-                    await ctx.cogs["Database"].inventory_add(user_id=ctx.author.id, name=name)
+            await ctx.cogs["Database"].inventory_add_many(
+                ctx.author.id, {name: (count, 0) for name, count in kept.items()}
+            )
 
         await ctx.send(embed=embed)
 
@@ -387,18 +388,14 @@ class Currency(commands.Cog, name="Currency & Items"):
         Rest through the horrors of the night.
         """
 
-        results = await ctx.db["game_time"].find_one(user_id=ctx.author.id)
-        if results:
-            current_time = results["minutes"]
-        else:
-            current_time = 600
+        current_time = await ctx.cogs["Database"].game_time(ctx.author.id)
 
         if 390 < current_time < 1050:
             return await ctx.send("You can only sleep at night!")
 
         # morning simulator 2k20
         new_time = random.choice([560, 580, 600, 620, 640])
-        await ctx.db["game_time"].upsert(["user_id"], user_id=ctx.author.id, minutes=new_time)
+        await ctx.cogs["Database"].game_set_time(ctx.author.id, new_time)
 
         # build embed
         emoji_time_display, time_printable = self.calculate_time_details(new_time)
@@ -420,42 +417,40 @@ class Currency(commands.Cog, name="Currency & Items"):
         Use your materials to build something new.
         """
 
-        to_craft = ITEM_MAPPING.get(item.lower(), {}).get("crafting", {})
-        if not to_craft:
+        to_craft = ITEMS[item.lower()]
+        recipe = to_craft.recipe
+        if not recipe:
             return await ctx.send("That's not a craftable item!")
 
-        to_craft["name"] = item.lower()  # helper
-
-        # get inventory, collate counts
-        inventory = await self.db["inventory"].find(user_id=ctx.author.id)  # :grimace:
-        # i want to make this counting stuff SQL but not sure how to do that yet, will look later
-        item_names = [item["name"] for item in inventory]
-        item_counts = collections.Counter(item_names)
+        # check for, use up and create items all at once - this also advances time if it succeeds
+        result = await ctx.cogs["Database"].craft(
+            ctx.author.id,
+            ingredients=recipe.ingredients,
+            workbench=recipe.made_with,
+            product=recipe.product,
+            makes=recipe.makes,
+            durability=to_craft.durability,
+            minutes=40
+        )
 
         # needs a workbench we don't have
-        if to_craft["made_with"] and to_craft["made_with"] not in item_counts:
-            return await ctx.send(f"You need a **{to_craft['made_with'].capitalize()}** to craft this!")
+        if not result["has_workbench"]:
+            return await ctx.send(f"You need a **{recipe.made_with.capitalize()}** to craft this!")
 
         # make the item summary
-        can_craft = True
         summary = []
-        for item in to_craft["ingredients"]:
-            if item["amount"] > item_counts[item["name"]]:
-                can_craft = False
-                delta = item["amount"] - item_counts[item["name"]]
-                summary.append(f"❌ {item['amount']}x **{item['name'].capitalize()}**. You need {delta} more!")
+        for ingredient, amount, owned in zip(recipe.names, recipe.amounts, result["owned"]):
+            if amount > owned:
+                summary.append(f"❌ {amount}x **{ingredient.capitalize()}**. You need {amount - owned} more!")
             else:
-                summary.append(f"✅ {item['amount']}x **{item['name'].capitalize()}**. You have enough of this item!")
+                summary.append(f"✅ {amount}x **{ingredient.capitalize()}**. You have enough of this item!")
 
-        if can_craft:
-            # we have everything, so advance time
-            await ctx.cogs["Database"].game_advance_time(ctx.author.id, 40)
-            current_time = (await ctx.db["game_time"].find_one(user_id=ctx.author.id))["minutes"]
-            emoji_time_display, time_printable = self.calculate_time_details(current_time)
+        if result["crafted"]:
+            emoji_time_display, time_printable = self.calculate_time_details(result["current_minutes"])
             summary.append(f"\n{' '.join(list(emoji_time_display)[:5])}")
             summary.append(
                 f"The current time is {time_printable}. "
-                f"You spent 40 minutes crafting and made {to_craft['makes']}x **{to_craft['name'].capitalize()}**"
+                f"You spent 40 minutes crafting and made {recipe.makes}x **{recipe.product.capitalize()}**"
             )
         else:
             summary.append("\nYou're missing items that you need!")
@@ -465,23 +460,6 @@ class Currency(commands.Cog, name="Currency & Items"):
         embed.set_author(name=ctx.author.name, icon_url=ctx.author.avatar_url)
         embed.description = "\n".join(summary)
 
-        if can_craft:
-            # remove items from inventory
-            for ingredient in to_craft["ingredients"]:
-                await ctx.cogs["Database"].inventory_remove(
-                    user_id=ctx.author.id, name=ingredient["name"], quantity=ingredient["amount"]
-                )
-
-            # try tool information, :grimace: this is suuuuper ugly
-            new_durability = ITEM_MAPPING[to_craft["name"]].get("tool", {"durability": 0})["durability"]
-
-            # add new crafted item to inventory
-            # TODO: fix this so that it doesn't chug with many insertions
-            for _ in range(to_craft["makes"]):
-                await ctx.cogs["Database"].inventory_add(
-                    user_id=ctx.author.id, name=to_craft["name"], durability=new_durability
-                )
-
         await ctx.send(embed=embed)
 
     @commands.command()
@@ -492,21 +470,17 @@ class Currency(commands.Cog, name="Currency & Items"):
         """
 
         # get inventory so that we know what we can make
-        inventory_names = [item["name"] for item in await self.db["inventory"].find(user_id=ctx.author.id)]
+        item_counts = await ctx.cogs["Database"].inventory_counts(ctx.author.id)
         can_be_crafted = []
-        for name, data in ITEM_MAPPING.items():
-            info = data.get("crafting", None)
-            if not info:
-                continue
-
-            # it either doesn't require a workbench (False) or we have the workbench that we need
-            if info["made_with"] in inventory_names or not info["made_with"]:
-                if info["made_with"]:
-                    can_be_crafted.append(
-                        f"With ``{info['made_with'].capitalize()}``: **{name.capitalize()}**"
-                    )
-                else:
-                    can_be_crafted.append(f"**{name.capitalize()}** (no requirements)")
+        # recipes that either don't require a workbench (None) or need a workbench that we have
+        workbenches = [workbench for workbench in ITEMS.recipes_by_workbench if workbench in item_counts]
+        for recipe in ITEMS.recipes_for((None, *workbenches)):
+            if recipe.made_with:
+                can_be_crafted.append(
+                    f"With ``{recipe.made_with.capitalize()}``: **{recipe.product.capitalize()}**"
+                )
+            else:
+                can_be_crafted.append(f"**{recipe.product.capitalize()}** (no requirements)")
 
         # build a menu out of it
         pages = menuclasses.ListPageMenu(
@@ -538,16 +512,12 @@ class Currency(commands.Cog, name="Currency & Items"):
         Spin the Moonlit Wheel in search of wealth!
         """
 
-        # check if they have enough to spin
-        currency = await self.db["currency"].find_one(user_id=ctx.author.id)
-        amount_owned = currency["amount"] if currency else 0
-
-        if amount_owned < 50:
+        # take money away in advance, if they have enough to spin
+        guild_id = ctx.guild.id if ctx.guild else None
+        if await ctx.cogs["Database"].currency_spend(ctx.author.id, 50, guild_id) is None:
+            amount_owned = await ctx.cogs["Database"].currency_balance(ctx.author.id)
             return await ctx.send(f"You need at least **50** {COIN} to do this! You have **{amount_owned}** {COIN}")
 
-        # take money away in advance
-        await self.add_currency(ctx.author.id, -50)
-
         wheel = MOON_WHEELS.copy()
         wheel.rotate(random.randint(0, 8))  # these numbers bear no significance whatsoever
 
@@ -572,7 +542,7 @@ class Currency(commands.Cog, name="Currency & Items"):
             await message.edit(embed=embed)
 
         # finally, give them the money
-        await self.add_currency(ctx.author.id, MOON_WHEEL_INFO[wheel[0]]["amount"])
+        await self.add_currency(ctx.author.id, MOON_WHEEL_INFO[wheel[0]]["amount"], guild_id)
 
 
 def setup(bot):
@@ -1,88 +1,360 @@
-from typing import Union
+import asyncio
+import collections
+from typing import Union, Optional, Dict, Tuple, Mapping
 import bigbeans
 import pendulum
 
 from discord.ext import commands
+from extensions.models import queryclasses, cacheclasses, rankingclasses
 
 
-def wrap_around(minimum_value, maximum_value, n):
-    if minimum_value < n < maximum_value:
-        return n
-    elif n > maximum_value:
-        return minimum_value + n
-    else:
-        return maximum_value - n
+# the number of minutes in a game day, and the time that new players start at
+DAY_LENGTH = 1440
+STARTING_TIME = 600
+
+
+def changed_counts(counts: Mapping[str, int], changes: Mapping[str, int]) -> Dict[str, int]:
+    """Applies changes to item counts, keeping them ordered by name and dropping anything that runs out."""
+
+    counts = collections.Counter(counts)
+    counts.update(changes)
+    return {name: counts[name] for name in sorted(counts) if counts[name] > 0}
 
 
 class Database(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot  # type: commands.Bot
+        self._cooldowns = {}  # type: Dict[Tuple[int, str], Optional[pendulum.DateTime]]
+        self._action_counts = {}  # type: Dict[Tuple[int, str], int]
+        self._action_count_deltas = {}  # type: Dict[Tuple[int, str], int]
+        self._flush_task = None  # type: Optional[asyncio.Task]
+        self._state = cacheclasses.StateCache(ttl=self.bot.config["database"]["state_ttl"])
+        self._reconcile_task = None  # type: Optional[asyncio.Task]
+        self.leaderboards = rankingclasses.Leaderboards()
 
     async def before_ready(self):
         self.db = self.bot.db  # type: bigbeans.databean.Databean
+        self.statements = self.bot.statements  # type: queryclasses.StatementRegistry
+
+        if self._flush_task is None:
+            self._flush_task = self.bot.loop.create_task(
+                self.flush_action_counts_every(self.bot.config["database"]["flush_interval"])
+            )
+
+        if self._reconcile_task is None:
+            self._reconcile_task = self.bot.loop.create_task(
+                self.reconcile_leaderboards_every(self.bot.config["database"]["leaderboard_interval"])
+            )
+
+    async def before_close(self):
+        await self.flush_action_counts()
+
+    def cog_unload(self):
+        for task in (self._flush_task, self._reconcile_task):
+            if task is not None:
+                task.cancel()
+
+        # don't lose anything that's still buffered when the extension is reloaded
+        self.bot.loop.create_task(self.flush_action_counts())
+
+    async def _cached(self, user_id: int, field: str, read):
+        # balances, times and inventory counts are kept for a little while after they're read
+        # everything in this cog that changes them updates the cached copy too
+        value = self._state.get(user_id, field)
+        if value is cacheclasses.MISSING:
+            generation = self._state.generation(user_id)
+            value = await read()
+            self._state.load(user_id, field, value, generation)
+
+        return value
 
     # inventory schema:
     # user_id: int, the owner of this item
     # name: text, the name of this item
     # durability: int, the durability of this item (this ties into tool stuff)
+    # only items with durability get a row each here - everything else is counted in inventory_stacks
+
+    # inventory_stacks schema:
+    # user_id: int, the owner of these items
+    # name: text, the name of these items
+    # count: int, how many of this item the user has - this can be 0, in which case the user has none
+
     async def inventory_add(self, user_id: int, name: str, durability: int = 0):
-        await self.db["inventory"].insert(user_id=user_id, name=name, durability=durability)
-
-    async def inventory_remove(self, user_id: int, name: str, quantity: int):
-        # because postgresql is stupid and i can't be fucked dealing with it at midnight i'm going to do this a bad way
-        results = await self.db["inventory"].find(user_id=user_id, name=name)
-        ids = [str(_id["_id"]) for _, _id in zip(range(quantity), results)]  # dumb way to get only x ids
-        query = (
-            f"""DELETE FROM inventory
-            WHERE _id IN ({', '.join(ids)})"""
+        await self.inventory_add_many(user_id, {name: (1, durability)})
+
+    async def inventory_add_many(self, user_id: int, items: Mapping[str, Tuple[int, int]]):
+        """
+        Adds many items to a user's inventory in one go.
+        items should map item names to a tuple of (count, durability).
+        """
+
+        items = {name: (count, int(durability or 0)) for name, (count, durability) in items.items() if count > 0}
+        if not items:
+            return
+
+        await self.statements.execute(
+            "inventory_add_many",
+            user_id, list(items), [count for count, _ in items.values()], [d for _, d in items.values()]
+        )
+
+        self._state.update(
+            user_id, "inventory", lambda counts: changed_counts(counts, {n: c for n, (c, _) in items.items()})
+        )
+
+    async def inventory_remove(self, user_id: int, name: str, quantity: int) -> int:
+        """
+        Removes up to quantity of an item from a user's inventory, returning how many were actually removed.
+        Stacked items are removed first, and then individual items.
+        """
+
+        removed = await self.statements.fetchval("inventory_remove", user_id, name, quantity)
+        self._state.update(user_id, "inventory", lambda counts: changed_counts(counts, {name: -removed}))
+        return removed
+
+    async def inventory_counts(self, user_id: int) -> Dict[str, int]:
+        """
+        Returns how many of each item a user has, ordered by item name.
+        """
+
+        async def read():
+            results = await self.statements.fetch("inventory_counts", user_id)
+            return {result["name"]: result["count"] for result in results}
+
+        return dict(await self._cached(user_id, "inventory", read))
+
+    async def inventory_strongest_weapon(self, user_id: int):
+        """
+        Returns the row of the strongest weapon that a user has, with its strength, or None if they have no weapons.
+        """
+
+        return await self.statements.fetchrow("inventory_strongest_weapon", user_id)
+
+    async def inventory_wear_item(self, item_id: int, amount: int) -> bool:
+        """
+        Takes durability from an item, removing it if it's worn out.
+        Returns whether the item was removed.
+        """
+
+        results = await self.statements.fetch("inventory_wear_item", item_id, amount)
+        for result in results:
+            self._state.update(result["user_id"], "inventory", lambda c: changed_counts(c, {result["name"]: -1}))
+
+        return bool(results)
+
+    async def craft(self, user_id: int, ingredients: Mapping[str, int], workbench: Optional[str],
+                    product: str, makes: int, durability: int, minutes: int):
+        """
+        Atomically checks for and consumes ingredients, adds the product and advances the user's time.
+        Returns a record with crafted, has_workbench, owned (the counts of each ingredient before crafting)
+        and current_minutes (the new time, or None if nothing was crafted).
+        """
+
+        result = await self.statements.fetchrow(
+            "craft", user_id, list(ingredients), list(ingredients.values()), workbench or None,
+            product, makes, int(durability or 0), minutes, STARTING_TIME, DAY_LENGTH
         )
 
-        await self.db.execute_query(query)
+        if result["crafted"]:
+            changes = collections.Counter({name: -amount for name, amount in ingredients.items()})
+            changes[product] += makes
+            self._state.update(user_id, "inventory", lambda counts: changed_counts(counts, changes))
+            self._state.set(user_id, "minutes", result["current_minutes"])
+
+        return result
+
+    # weapon_strength schema:
+    # name: text, the name of a weapon
+    # strength: int, how strong the weapon is
+    # this mirrors items.toml, so that the strongest weapon a user has can be found with a single query
+
+    async def weapon_strength_sync(self, strengths: Mapping[str, int]) -> None:
+        await self.statements.execute("weapon_strength_sync", list(strengths), list(strengths.values()))
+
+    # currency schema:
+    # user_id: int, the user that this balance belongs to
+    # amount: int, how much currency the user has
+
+    async def currency_balance(self, user_id: int) -> int:
+        async def read():
+            return await self.statements.fetchval("currency_balance", user_id) or 0
+
+        return await self._cached(user_id, "balance", read)
+
+    async def currency_add(self, user_id: int, amount: int, guild_id: Optional[int] = None) -> int:
+        """
+        Atomically adds amount (which can be negative) to a user's balance, returning the new balance.
+        If guild_id is given, the user is ranked on that guild's leaderboard from now on.
+        """
+
+        balance = await self.statements.fetchval("currency_add", user_id, amount)
+        await self.currency_changed(user_id, balance, guild_id)
+        return balance
+
+    async def currency_spend(self, user_id: int, amount: int, guild_id: Optional[int] = None) -> Optional[int]:
+        """
+        Atomically takes amount from a user's balance if they have at least that much.
+        Returns the new balance, or None if they couldn't afford it.
+        """
+
+        balance = await self.statements.fetchval("currency_spend", user_id, amount)
+        if balance is None:
+            self._state.invalidate(user_id, "balance")  # whatever we had cached was wrong if it said they could
+        else:
+            await self.currency_changed(user_id, balance, guild_id)
+
+        return balance
+
+    async def currency_changed(self, user_id: int, balance: int, guild_id: Optional[int]) -> None:
+        self._state.set(user_id, "balance", balance)
+        if guild_id is not None and not self.leaderboards.has_played_in(user_id, guild_id):
+            await self.statements.execute("currency_guild_add", user_id, guild_id)
+
+        self.leaderboards.update(user_id, balance, guild_id)
+
+    async def reconcile_leaderboards(self) -> None:
+        """
+        Brings the leaderboards in line with the currency table, in case anything changed it behind our back.
+        """
+
+        self.leaderboards.start_reconciling()
+        balances = {result["user_id"]: result["amount"] for result in await self.statements.fetch("currency_all")}
+        memberships = collections.defaultdict(set)
+        for result in await self.statements.fetch("currency_guilds_all"):
+            memberships[result["user_id"]].add(result["guild_id"])
+
+        self.leaderboards.reconcile(balances, memberships)
+
+    async def reconcile_leaderboards_every(self, interval: float) -> None:
+        while True:
+            try:
+                await self.reconcile_leaderboards()
+            except Exception as error:
+                self.bot.logger.error("Couldn't reconcile leaderboards: %s", str(error))
+
+            await asyncio.sleep(interval)
 
     # extended_cooldown schema:
     # unique_id: int, this is the "owner" of this cooldown
     # cooldown_group: text, this is the "group" that the cooldown belongs to - mainly an ease-of-use thing
-    # last_accessed: tz-aware pendulum timestamp as text, this is the date that the cooldown was last triggered
+    # last_accessed: timestamptz, this is the date that the cooldown was last triggered
+    # cooldowns are cached in memory after they're first read, and written through when set
 
-    async def cooldown_query(self, unique_id: int, cooldown_group: str, duration: pendulum.Duration) -> Union[bool, pendulum.Period]:
+    async def cooldown_last_accessed(self, unique_id: int, cooldown_group: str) -> Optional[pendulum.DateTime]:
+        key = (unique_id, cooldown_group)
+        try:
+            return self._cooldowns[key]
+        except KeyError:
+            result = await self.statements.fetchval("cooldown_last_accessed", unique_id, cooldown_group)
+            last_accessed = pendulum.instance(result) if result else None
+            self._cooldowns[key] = last_accessed
+            return last_accessed
+
+    async def cooldown_query(self, unique_id: int, cooldown_group: str, duration: pendulum.Duration) -> Union[bool, pendulum.DateTime]:
         """
-        Return False if unique_id is not on cooldown, or time remaining if it is.
+        Return False if unique_id is not on cooldown, or the time that the cooldown expires if it is.
         """
 
-        result = await self.db["extended_cooldown"].find_one(unique_id=unique_id, cooldown_group=cooldown_group)
-        if not result:
+        last_accessed = await self.cooldown_last_accessed(unique_id, cooldown_group)
+        if last_accessed is None or pendulum.now() - last_accessed > duration:
             return False
         else:
-            now = pendulum.now()
-            last_accessed = pendulum.parse(result["last_accessed"])  # type: pendulum.DateTime
-            delta = now - last_accessed
-            if delta > duration:
-                return False
-            else:
-                return last_accessed + duration
+            return last_accessed + duration
 
     async def cooldown_set(self, unique_id: int, cooldown_group: str) -> None:
         """
         Sets a cooldown for unique_id in the specified group.
         """
 
-        now = str(pendulum.now())
-        await self.db["extended_cooldown"].upsert(
-            ["unique_id", "cooldown_group"], unique_id=unique_id, cooldown_group=cooldown_group, last_accessed=now
-        )
+        now = pendulum.now()
+        await self.statements.execute("cooldown_set", unique_id, cooldown_group, now)
+
+        self._cooldowns[(unique_id, cooldown_group)] = now
 
     # game_time schema
     # user_id: int, the user the time is relevant to
     # minutes: int, the time in minutes for the user
-    async def game_advance_time(self, user_id: int, minutes: int):
-        result = await self.db["game_time"].find_one(user_id=user_id)
-        if not result:
-            await self.db["game_time"].insert(user_id=user_id, minutes=wrap_around(0, 1440, 600 + minutes))
-        else:
-            await self.db["game_time"].upsert(
-                ["user_id"], user_id=user_id, minutes=wrap_around(0, 1440, result["minutes"] + minutes)
+
+    async def game_time(self, user_id: int) -> int:
+        async def read():
+            minutes = await self.statements.fetchval("game_time", user_id)
+            return STARTING_TIME if minutes is None else minutes
+
+        return await self._cached(user_id, "minutes", read)
+
+    async def game_set_time(self, user_id: int, minutes: int) -> None:
+        await self.statements.execute("game_set_time", user_id, minutes)
+        self._state.set(user_id, "minutes", minutes)
+
+    async def game_advance_time(self, user_id: int, minutes: int) -> int:
+        """
+        Advances a user's time by the given number of minutes, wrapping around at the end of the day.
+        Returns the new time.
+        """
+
+        current_minutes = await self.statements.fetchval(
+            "game_advance_time", user_id, STARTING_TIME, minutes, DAY_LENGTH
+        )
+
+        self._state.set(user_id, "minutes", current_minutes)
+        return current_minutes
+
+    # action_counts schema
+    # user_id: int, the user that did the action
+    # action: text, the name of the action (like "hug")
+    # amount: int, how many times the user has done it
+    # counts are cached in memory after they're first read - additions are buffered and written in batches
+
+    async def action_count(self, user_id: int, action: str) -> int:
+        key = (user_id, action)
+        try:
+            return self._action_counts[key]
+        except KeyError:
+            amount = await self.statements.fetchval("action_count", user_id, action) or 0
+            return self._action_counts.setdefault(key, amount)
+
+    async def action_count_add(self, user_id: int, action: str, amount: int) -> int:
+        """
+        Adds to the number of times a user has done an action, returning the new count.
+        The new count is visible immediately, but it's only written to the DB on the next flush.
+        """
+
+        # the count has to be known before anything is buffered for it, or a flush could be counted twice
+        await self.action_count(user_id, action)
+
+        key = (user_id, action)
+        self._action_count_deltas[key] = self._action_count_deltas.get(key, 0) + amount
+        self._action_counts[key] += amount
+        return self._action_counts[key]
+
+    async def flush_action_counts(self) -> None:
+        """
+        Writes every buffered addition to action_counts in one statement.
+        """
+
+        deltas, self._action_count_deltas = self._action_count_deltas, {}
+        if not deltas:
+            return
+
+        try:
+            await self.statements.execute(
+                "action_count_add_many",
+                [user_id for user_id, _ in deltas], [action for _, action in deltas], list(deltas.values())
             )
+        except Exception:
+            # put everything back so that the next flush can try again
+            for key, amount in deltas.items():
+                self._action_count_deltas[key] = self._action_count_deltas.get(key, 0) + amount
+
+            raise
+
+    async def flush_action_counts_every(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_action_counts()
+            except Exception as error:
+                self.bot.logger.error("Couldn't flush action counts: %s", str(error))
 
 
 def setup(bot):
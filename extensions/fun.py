@@ -150,8 +150,7 @@ class Fun(commands.Cog):
             mention_string = ", ".join([person.mention for person in people[:-1]]) + f" and {people[-1].mention} have"
 
         # get some gnome stats
-        gnome_results = await self.db["action_counts"].find_one(user_id=ctx.author.id, action="gnome")
-        current_gnome_count = gnome_results['amount'] if gnome_results else 0
+        current_gnome_count = await ctx.cogs["Database"].action_count(ctx.author.id, "gnome")
 
         # build embed
         results = await self.lobstero_api_request(ctx, None, "gnomes")
@@ -163,10 +162,7 @@ class Fun(commands.Cog):
         )
 
         # update gnome stats
-        await self.db["action_counts"].upsert(
-            ["user_id", "gnome"],
-            user_id=ctx.author.id, action="gnome", amount=current_gnome_count + len(people)
-        )
+        await ctx.cogs["Database"].action_count_add(ctx.author.id, "gnome", len(people))
 
         await ctx.send(embed=results["embed"], file=results["file"])
 
@@ -265,8 +261,7 @@ class Fun(commands.Cog):
             mention_string = ", ".join([person.mention for person in people[:-1]]) + f" and {people[-1].mention}!"
 
         # get some hug stats
-        hug_results = await self.db["action_counts"].find_one(user_id=ctx.author.id, action="hug")
-        current_hug_count = hug_results["amount"] if hug_results else 0
+        current_hug_count = await ctx.cogs["Database"].action_count(ctx.author.id, "hug")
 
         # tell them about badges
         message = None
@@ -281,9 +276,7 @@ class Fun(commands.Cog):
                 message = f"**Psst!** You're **{abs(until_next) + 1}** hugs away from a new badge!"
 
         # update the DB with new data
-        await self.db["action_counts"].upsert(
-            ["user_id", "hug"], user_id=ctx.author.id, action="hug", amount=new_hugs
-        )
+        await ctx.cogs["Database"].action_count_add(ctx.author.id, "hug", len(people))
 
         # build embed
         embed = discord.Embed(color=16202876)
@@ -299,8 +292,7 @@ class Fun(commands.Cog):
         """
 
         # get some hug stats
-        hug_results = await self.db["action_counts"].find_one(user_id=ctx.author.id, action="hug")
-        current_hug_count = hug_results["amount"] if hug_results else 0
+        current_hug_count = await ctx.cogs["Database"].action_count(ctx.author.id, "hug")
 
         # we make a list of badges that are locked by default, and fill them in with unlocked ones later on
         badge_list = [LOCKED_HUG for _ in range(5)]
@@ -17,6 +17,7 @@ from PIL import ImageFilter, ImageFont, Image, ImageDraw, ImageEnhance, ImageOps
 from discord.ext import commands
 from jishaku.codeblocks import codeblock_converter
 from extensions.external import asciify, kromo, halftone
+from extensions.models import metricsclasses
 from extensions.models.exceptions import (
     ImageScriptException, MissingBracketsException, MissingSemicolonException, UnknownOperationException,
     TooMuchToDoException, BadInputException, BadSyntaxException, MissingColonException
@@ -104,7 +105,8 @@ class Editing(commands.Cog):
         """
 
         new_func = functools.partial(func, *args, **kwargs)
-        output = await self.bot.loop.run_in_executor(None, new_func)
+        with metricsclasses.timed("executor"):
+            output = await self.bot.loop.run_in_executor(None, new_func)
 
         return output
 
@@ -60,11 +60,11 @@ class Meta(commands.Cog):
         Regardless of this server's locked channels, these commands can always be used.
         """
 
-        results = await self.db["channel_locks"].find(guild_id=ctx.guild.id)
+        results = await self.bot.channel_locks(ctx.guild.id)
         if not results:
             return await ctx.send("No locked channels set on this server.")
 
-        mentions = [f"<#{result['channel_id']}>" for result in results]
+        mentions = [f"<#{channel_id}>" for channel_id in sorted(results)]
         pages = menuclasses.ListPageMenu(
             mentions, 10, menuclasses.title_page_number_formatter("Locked channels")
         )
@@ -85,7 +85,7 @@ class Meta(commands.Cog):
         """
 
         channel = channel or ctx.channel
-        await self.db["channel_locks"].upsert(["guild_id", "channel_id"], guild_id=ctx.guild.id, channel_id=channel.id)
+        await self.bot.add_channel_lock(ctx.guild.id, channel.id)
         await ctx.send(f"Locked bot usage to {channel.mention}.")
 
     @commands.guild_only()
@@ -99,7 +99,7 @@ class Meta(commands.Cog):
         """
 
         channel = channel or ctx.channel
-        await self.db["channel_locks"].delete(guild_id=ctx.guild.id, channel_id=channel.id)
+        await self.bot.remove_channel_lock(ctx.guild.id, channel.id)
         await ctx.send(f"Removed {channel.mention} from the list of locked channels.")
 
 
@@ -1,20 +1,23 @@
 import random
-import difflib
 import logging
 import traceback
 import re
 import inspect
+import time
 
 from collections import defaultdict
-from typing import Sequence, Iterator, Optional, KeysView, MutableMapping
+from typing import Sequence, List, Optional, MutableMapping, Set, Tuple
 
 import bigbeans
 import discord
 import uwuify
 import aiohttp
 
+from aiohttp import web
+
 from discord.ext import commands, menus
-from . import menuclasses, exceptions
+from . import menuclasses, markovclasses, indexclasses, metricsclasses, exceptions
+from . import schemaclasses, queryclasses, memoryclasses
 
 logging.basicConfig(level=logging.INFO)
 
@@ -33,6 +36,31 @@ HELP_ALIASES = [
     "hylp"
     ]
 
+# how long the results of permission checks for help are kept around, in seconds
+HELP_CACHE_TTL = 60
+
+# the number of edges a guild's own markov chain needs before it's used for replies
+MINIMUM_GUILD_CHAIN_SIZE = 1000
+
+# settings that older config files won't have, and what they default to - these match config.example.toml
+CONFIG_DEFAULTS = {
+    "markov": {
+        "pool_size": 60,
+        "per_guild": False,
+        "guild_directory": "markov_guilds",
+        "max_guilds": 100,
+        "guild_budget": 50000
+    },
+    "database": {
+        "backend": "postgres",
+        "latency_ms": 0,
+        "flush_interval": 5,
+        "state_ttl": 30,
+        "leaderboard_interval": 600
+    },
+    "metrics": {"enabled": True, "host": "127.0.0.1", "port": 9100, "lag_threshold_ms": 100}
+}
+
 
 class CustomContext(commands.Context):
 
@@ -45,6 +73,10 @@ class CustomContext(commands.Context):
         cog_dict = defaultdict(lambda: None)
         return cog_dict.update(self.bot.cogs) or cog_dict
 
+    async def send(self, *args, **kwargs):
+        with metricsclasses.timed("send"):
+            return await super().send(*args, **kwargs)
+
 
 class CustomHelpCommand(commands.HelpCommand):
 
@@ -87,9 +119,35 @@ class CustomHelpCommand(commands.HelpCommand):
 
         return usable_commands
 
+    async def cached_usable_commands(self, cog) -> List[commands.Command]:
+        """
+        Returns the commands in a cog that can be used in this context.
+        Results are cached for a short time per guild and set of permissions, so repeated help is cheap.
+        """
+
+        ctx = self.context
+        key = (
+            cog.qualified_name,
+            ctx.guild.id if ctx.guild else None,
+            ctx.channel.permissions_for(ctx.author).value,
+            await ctx.bot.is_owner(ctx.author)
+        )
+
+        now = time.monotonic()
+        cached = ctx.bot._help_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        results = await self.usable_commands(cog.get_commands())
+        if len(ctx.bot._help_cache) > 1000:  # don't let stale entries pile up
+            ctx.bot._help_cache = {k: v for k, v in ctx.bot._help_cache.items() if v[0] > now}
+
+        ctx.bot._help_cache[key] = (now + HELP_CACHE_TTL, results)
+        return results
+
     async def generate_cog_help(self, cog) -> discord.Embed:
         retrieved_commands = cog.get_commands()
-        results = await self.usable_commands(retrieved_commands)
+        results = await self.cached_usable_commands(cog)
 
         if not results:  # empty list
             return None
@@ -169,9 +227,6 @@ class CustomHelpCommand(commands.HelpCommand):
         embed = discord.Embed(title="Help", color=16202876)
 
         cogs = sorted(self.context.bot.cogs.values(), key=lambda c: c.qualified_name)
-        raw_pages = [await self.generate_cog_help(cog) for cog in cogs]
-        cog_pages = filter(None, raw_pages)  # type: Iterator[discord.Embed]
-
         description = [
             "From here, you can:",
             "_ _   • Use the reactions below to navigate between module help pages.",
@@ -183,7 +238,11 @@ class CustomHelpCommand(commands.HelpCommand):
         embed.description = "\n".join(description)
         embed = await self.check_and_jumble(embed)
 
-        pages = menuclasses.EmbedPageMenu([embed] + list(cog_pages), menuclasses.title_page_number_formatter("Help"))
+        # cog pages are only built when they're navigated to
+        pages = menuclasses.LazyEmbedPageMenu(
+            embed, cogs, self.generate_cog_help, menuclasses.lazy_title_page_number_formatter("Help")
+        )
+
         menu = menus.MenuPages(pages, timeout=90)
         await menu.start(self.context)
 
@@ -199,13 +258,14 @@ class CustomHelpCommand(commands.HelpCommand):
         return r
 
     async def send_error_message(self, error):
-        usable = [c.qualified_name for c in await self.usable_commands(self.context.bot.walk_commands())]
         if not self.not_found:
             command_matches = cog_matches = False
         else:
-            usable_cogs = self.context.bot.cogs.keys()  # type: KeysView
-            command_matches = difflib.get_close_matches(self.not_found, usable)
-            cog_matches = difflib.get_close_matches(self.not_found, usable_cogs)
+            # only the closest few commands need their permissions checked, not every command the bot has
+            index = self.context.bot.command_index
+            usable = await self.usable_commands(index.suggest_commands(self.not_found))
+            command_matches = [c.qualified_name for c in usable][:3]
+            cog_matches = index.suggest_cogs(self.not_found)
 
         if not (command_matches or cog_matches):
             return await self.context.send(error)
@@ -226,12 +286,61 @@ class CustomHelpCommand(commands.HelpCommand):
 class Lobstero(commands.AutoShardedBot):
 
     def __init__(self, *args, config: MutableMapping, **kwargs) -> None:
+        for section, defaults in CONFIG_DEFAULTS.items():
+            for key, value in defaults.items():
+                config.setdefault(section, {}).setdefault(key, value)
+
         self.config = config
         self.session = aiohttp.ClientSession()
         self.logger = logging.getLogger("Lobstero")
         self.first_ready = True
+        self._channel_locks = {}  # type: MutableMapping[int, Set[int]]
+        self._command_index = None  # type: Optional[indexclasses.CommandIndex]
+        self._help_cache = {}
+        self.metrics = metricsclasses.CommandMetrics()
+        self.lag_monitor = metricsclasses.LoopLagMonitor(threshold=config["metrics"]["lag_threshold_ms"] / 1000)
+        self._metrics_runner = None  # type: Optional[web.AppRunner]
+        self._mention_patterns = ()  # type: Tuple[str, ...]
+        self._markov_model = None  # type: Optional[markovclasses.CompactChain]
+        self._markov_pool = None  # type: Optional[markovclasses.SentencePool]
+        self._markov_failed = False  # set if the model couldn't be loaded, so that we stop saying it's warming up
+        self._guild_chains = None  # type: Optional[markovclasses.GuildChains]
+        if config["markov"]["use_markov"] and config["markov"]["per_guild"]:
+            self._guild_chains = markovclasses.GuildChains(
+                config["markov"]["guild_directory"],
+                max_guilds=config["markov"]["max_guilds"],
+                budget=config["markov"]["guild_budget"]
+            )
         super().__init__(*args, **kwargs)
 
+        # a callable prefix can't be checked ahead of time, so the pre-filter is disabled in that case
+        if isinstance(self.command_prefix, str):
+            self._static_prefixes = (self.command_prefix, )  # type: Optional[Tuple[str, ...]]
+        elif isinstance(self.command_prefix, (list, tuple)):
+            self._static_prefixes = tuple(self.command_prefix)
+        else:
+            self._static_prefixes = None
+
+    @property
+    def command_index(self) -> indexclasses.CommandIndex:
+        if self._command_index is None:
+            self._command_index = indexclasses.CommandIndex(self)
+
+        return self._command_index
+
+    # the command index is rebuilt lazily whenever the loaded extensions change
+    def load_extension(self, name):
+        self._command_index = None
+        super().load_extension(name)
+
+    def reload_extension(self, name):
+        self._command_index = None
+        super().reload_extension(name)
+
+    def unload_extension(self, name):
+        self._command_index = None
+        super().unload_extension(name)
+
     def _unwrapped_markov(self) -> str:
         result = ""
         for _ in range(random.randint(1, 6)):
@@ -239,38 +348,88 @@ class Lobstero(commands.AutoShardedBot):
 
         return result
 
+    async def load_markov(self) -> None:
+        """
+        Loads (or builds) the markov model in the background, then starts keeping the sentence pool topped up.
+        Until this finishes, markov() will report that it's still warming up - or that it's unavailable, if it fails.
+        """
+
+        self.logger.info("Loading markov model in the background.")
+        started = time.perf_counter()
+        try:
+            self._markov_model = await self.loop.run_in_executor(
+                self._pool, markovclasses.load_compact_chain, self.config["markov"]["filepath"], self.logger
+            )
+        except Exception as error:
+            self.logger.critical("Could not load markov model: %s", str(error))
+            self._markov_failed = True
+            return
+
+        self.logger.info("Markov model ready after %.2f seconds.", time.perf_counter() - started)
+
+        # start keeping a pool of markov sentences topped up in the background
+        self._markov_pool = markovclasses.SentencePool(
+            lambda: self._markov_model.make_short_sentence(140), size=self.config["markov"]["pool_size"]
+        )
+
+        await self._markov_pool.fill(self.loop, self._pool)
+
     async def markov(self, ctx) -> str:
-        if self._markov_model is None:
+        guild_chain = None
+        if self._guild_chains is not None and ctx.guild:
+            guild_chain = self._guild_chains.peek(ctx.guild.id)
+
+        if not self.config["markov"]["use_markov"]:
             return "Markov is not configured."
+
+        result = ""
+        if guild_chain is not None and guild_chain.size >= MINIMUM_GUILD_CHAIN_SIZE:
+            # this guild has talked enough to get its own replies - these are cheap, so no executor needed
+            sentences = (guild_chain.make_short_sentence(140) for _ in range(random.randint(1, 6)))
+            result = " ".join(filter(None, sentences))
+
+        # if the guild's chain couldn't come up with anything, fall back to the global model
+        if result:
+            result = f"{result} "
+        elif self._markov_failed:
+            return "Markov is unavailable right now, sorry!"
+        elif self._markov_model is None:
+            return "Markov is still warming up! Try again in a bit."
         else:
-            result = f"{await self.loop.run_in_executor(self._pool, self._unwrapped_markov)} "
-            result = re.sub("<@(!?)([0-9]*)>", ctx.author.mention, result)
-            if ctx.guild:
-                result = re.sub("<#([0-9]*)>", lambda _: random.choice(ctx.guild.channels).mention, result)
-
-            result = re.sub(
-                "<(?P<animated>a?):(?P<name>[a-zA-Z0-9_]{2,32}):(?P<id>[0-9]{18,22})>",
-                lambda _: str(random.choice(self.emojis)), result
-            )
+            # use pre-generated sentences if we have enough of them, otherwise generate some on the spot
+            sentences = self._markov_pool.take(random.randint(1, 6)) if self._markov_pool is not None else None
+            if sentences:
+                result = f"{' '.join(sentences)} "
+            else:
+                with metricsclasses.timed("executor"):
+                    result = f"{await self.loop.run_in_executor(self._pool, self._unwrapped_markov)} "
+
+        result = re.sub("<@(!?)([0-9]*)>", ctx.author.mention, result)
+        if ctx.guild:
+            result = re.sub("<#([0-9]*)>", lambda _: random.choice(ctx.guild.channels).mention, result)
 
-            return result
+        result = re.sub(
+            "<(?P<animated>a?):(?P<name>[a-zA-Z0-9_]{2,32}):(?P<id>[0-9]{18,22})>",
+            lambda _: str(random.choice(self.emojis)), result
+        )
+
+        return result
 
     async def login(self, *args, **kwargs):
         # we override this and use it as an async pre-ready hook
         # in this case, we're connecting to the DB now so that it's usable immediately upon ready
-        try:
-            self.db = await bigbeans.connect(
-                host=self.config["database"]["server"],
-                port=self.config["database"]["port"],
-                database=self.config["database"]["database_name"],
-                user=self.config["database"]["username"],
-                password=self.config["database"]["password"]
-            )
-        except Exception as error:
-            self.logger.critical("Connection to database failed: %s", str(error))
-            exit()
+        if self.config["database"]["backend"] == "memory":
+            db = memoryclasses.MemoryDatabean(latency=self.config["database"]["latency_ms"] / 1000)
+            self.db = metricsclasses.TimedProxy(db, "db")
+            self.statements = memoryclasses.MemoryStatementRegistry(db)
+            self.logger.warning("Using an in-memory database. Nothing will be saved!")
         else:
-            self.logger.info("Connection to database established.")
+            await self.connect_database()
+
+        if self.config["metrics"]["enabled"]:
+            await self.start_metrics_server()
+
+        self.loop.create_task(self.lag_monitor.sample())
 
         # iterate through our cogs, if any have a before_ready function, call it
         for cog in self.cogs.values():
@@ -285,28 +444,121 @@ class Lobstero(commands.AutoShardedBot):
             else:
                 self.logger.info("Cog %s has no before_ready function, skipping.", cog.qualified_name)
 
+        # the model can take minutes to build, so don't make connecting to discord wait for it
+        if self.config["markov"]["use_markov"]:
+            self.loop.create_task(self.load_markov())
+
+        if self._guild_chains is not None:
+            self.loop.create_task(self._guild_chains.persist(self.loop, self._pool))
+
         # normal login
         await super().login(*args, **kwargs)
 
+    async def connect_database(self) -> None:
+        try:
+            db = await bigbeans.connect(
+                host=self.config["database"]["server"],
+                port=self.config["database"]["port"],
+                database=self.config["database"]["database_name"],
+                user=self.config["database"]["username"],
+                password=self.config["database"]["password"]
+            )
+        except Exception as error:
+            self.logger.critical("Connection to database failed: %s", str(error))
+            exit()
+        else:
+            self.db = metricsclasses.TimedProxy(db, "db")  # so that DB waits show up in command metrics
+            self.statements = queryclasses.StatementRegistry(db.pool)
+            self.logger.info("Connection to database established.")
+
+        # the schema has to be up to date before any cog touches the database
+        try:
+            starting_version, current_version = await schemaclasses.migrate(self.db, self.logger)
+        except Exception as error:
+            self.logger.critical("Database schema migration failed: %s", str(error))
+            exit()
+        else:
+            self.logger.info("Database schema is at version %s (was %s).", current_version, starting_version)
+
+    async def start_metrics_server(self) -> None:
+        """
+        Serves command metrics in the prometheus text format.
+        This is only meant to be scraped locally, so it should be bound to localhost.
+        """
+
+        async def handler(_):
+            return web.Response(text=self.metrics.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handler)
+        self._metrics_runner = web.AppRunner(app)
+        await self._metrics_runner.setup()
+
+        # the port can already be taken, like when there's more than one bot process - that shouldn't stop the bot
+        site = web.TCPSite(self._metrics_runner, self.config["metrics"]["host"], self.config["metrics"]["port"])
+        try:
+            await site.start()
+        except OSError as error:
+            self.logger.error("Could not serve metrics on port %s: %s", self.config["metrics"]["port"], str(error))
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
+        else:
+            self.logger.info("Serving metrics on port %s.", self.config["metrics"]["port"])
+
+    async def channel_locks(self, guild_id: int) -> Set[int]:
+        """
+        Return the set of locked channel IDs for a guild.
+        Locks are loaded from the DB the first time a guild is seen, and kept in memory after that.
+        """
+
+        try:
+            return self._channel_locks[guild_id]
+        except KeyError:
+            results = await self.statements.fetch("channel_locks", guild_id)
+            locks = self._channel_locks[guild_id] = {int(item["channel_id"]) for item in results}
+            return locks
+
+    async def add_channel_lock(self, guild_id: int, channel_id: int) -> None:
+        await self.statements.execute("channel_lock_add", guild_id, channel_id)
+        if guild_id in self._channel_locks:
+            self._channel_locks[guild_id].add(channel_id)
+
+    async def remove_channel_lock(self, guild_id: int, channel_id: int) -> None:
+        await self.statements.execute("channel_lock_remove", guild_id, channel_id)
+        if guild_id in self._channel_locks:
+            self._channel_locks[guild_id].discard(channel_id)
+
     async def get_context(self, message, *, cls=CustomContext) -> CustomContext:
         return await super().get_context(message, cls=cls)
 
     async def on_ready(self):
+        self._mention_patterns = (f"<@{self.user.id}>", f"<@!{self.user.id}>")
         self.logger.info("Connection to discord established.")
 
+    def could_be_relevant(self, message) -> bool:
+        """
+        A cheap check for whether a message could be a command, a mention or crabversation traffic.
+        If this returns False, the message can be safely ignored without building a context.
+        """
+
+        content = message.content
+        if self._static_prefixes is None or content.startswith(self._static_prefixes):
+            return True
+
+        if any(pattern in content for pattern in self._mention_patterns):
+            return True
+
+        return message.guild is not None and "crabversation" in message.channel.name.lower()
+
     async def on_message(self, message):
-        if message.author.bot:
+        if message.author.bot or not self.could_be_relevant(message):
             return
 
         # get context - this is mainly for later
         ctx = await self.get_context(message)
 
-        # check if the bot can be used here
-        usage = []
-        if message.guild:
-            usage = await self.db["channel_locks"].find(guild_id=message.guild.id)
-
-        lock_channels = [int(item["channel_id"]) for item in usage]
+        # check if the bot can be used here - this is cached, so it only hits the DB once per guild
+        lock_channels = await self.channel_locks(message.guild.id) if message.guild else set()
 
         # if lock_channels is empty, no channels are locked and the bot can be used freely
         # if lock_channels is not empty and message channel is not in it, return - bot cannot be used here
@@ -318,8 +570,11 @@ class Lobstero(commands.AutoShardedBot):
             return
 
         # speak if spoken to, but only if a command isn't used
-        bot_mentioned = (f"<@{self.user.id}>" in message.content or f"<@!{self.user.id}>" in message.content)
+        bot_mentioned = any(pattern in message.content for pattern in self._mention_patterns)
         in_crabversation = "crabversation" in ctx.channel.name.lower() if ctx.guild else False
+        if in_crabversation and not ctx.command and self._guild_chains is not None:
+            await self._guild_chains.ingest(ctx.guild.id, message.content, self.loop, self._pool)
+
         if (bot_mentioned or in_crabversation) and not ctx.command:
             try:
                 await message.channel.send(await self.markov(ctx))
@@ -328,6 +583,36 @@ class Lobstero(commands.AutoShardedBot):
 
         await self.invoke(ctx)
 
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        token, invocation = self.metrics.start()
+        started = time.perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.finish(token, invocation, ctx.command.qualified_name, elapsed, ctx.command_failed)
+
+    async def close(self):
+        # give cogs a chance to write out anything they're holding onto while the DB is still around
+        for cog in self.cogs.values():
+            func = getattr(cog, "before_close", None)
+            if func:
+                try:
+                    await func()
+                except Exception as error:
+                    self.logger.error("Error while trying to close cog %s: %s", cog.qualified_name, str(error))
+
+        if self._guild_chains is not None:
+            await self._guild_chains.save_all(self.loop, self._pool)
+
+        if self._metrics_runner is not None:
+            await self._metrics_runner.cleanup()
+
+        await super().close()
+
     async def on_command_error(self, ctx, error):
         error = getattr(error, "original", error)  # just in case bb
 
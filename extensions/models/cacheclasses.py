@@ -0,0 +1,79 @@
+import time
+import collections
+
+from typing import Any, Callable, Dict, Tuple
+
+# returned by StateCache.get when a field isn't cached, since None is a perfectly good value to cache
+MISSING = object()
+
+
+class UserState():
+
+    def __init__(self):
+        self.generation = 0
+        self.fields = {}  # type: Dict[str, Tuple[float, Any]]
+
+
+class StateCache():
+    """Per-user fields (like a balance) that are kept for a short time after they're read.
+    Writes go through set(), update() or invalidate(), which all bump the user's generation - a read that started
+    before a write only gets stored if the generation hasn't changed since, so a slow read can't clobber a newer
+    value. Users that haven't been touched in a while are dropped once there are more than max_users."""
+
+    def __init__(self, ttl: float = 30, max_users: int = 10000):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.users = collections.OrderedDict()  # type: collections.OrderedDict
+
+    def _user(self, user_id: int) -> UserState:
+        try:
+            self.users.move_to_end(user_id)
+            return self.users[user_id]
+        except KeyError:
+            state = self.users[user_id] = UserState()
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+
+            return state
+
+    def get(self, user_id: int, field: str) -> Any:
+        state = self.users.get(user_id)
+        if state is None or field not in state.fields:
+            return MISSING
+
+        expires, value = state.fields[field]
+        if expires < time.monotonic():
+            del state.fields[field]
+            return MISSING
+
+        return value
+
+    def generation(self, user_id: int) -> int:
+        return self._user(user_id).generation
+
+    def load(self, user_id: int, field: str, value: Any, generation: int) -> None:
+        """Stores a value that was read from the DB, unless the user was written to since the read started."""
+
+        state = self.users.get(user_id)
+        if state is not None and state.generation == generation:
+            state.fields[field] = (time.monotonic() + self.ttl, value)
+
+    def set(self, user_id: int, field: str, value: Any) -> None:
+        state = self._user(user_id)
+        state.generation += 1
+        state.fields[field] = (time.monotonic() + self.ttl, value)
+
+    def update(self, user_id: int, field: str, function: Callable[[Any], Any]) -> None:
+        """Applies a change to a cached value in place. If the value isn't cached, it's left to be read again."""
+
+        value = self.get(user_id, field)
+        state = self._user(user_id)
+        state.generation += 1
+        if value is not MISSING:
+            expires, _ = state.fields[field]
+            state.fields[field] = (expires, function(value))
+
+    def invalidate(self, user_id: int, field: str) -> None:
+        state = self._user(user_id)
+        state.generation += 1
+        state.fields.pop(field, None)
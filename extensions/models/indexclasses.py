@@ -0,0 +1,50 @@
+import difflib
+
+from collections import Counter, defaultdict
+from typing import Iterable, List, Set, Mapping
+
+from discord.ext import commands
+
+
+class NgramIndex():
+    """A character n-gram index over a set of names.
+    This is used to narrow fuzzy matching down to a handful of candidates before handing them to difflib,
+    so that suggesting a name doesn't mean comparing against every name that exists."""
+
+    def __init__(self, names: Iterable[str], n: int = 3):
+        self.n = n
+        self.names = sorted(set(names))
+        self.postings = defaultdict(set)  # type: Mapping[str, Set[int]]
+        for i, name in enumerate(self.names):
+            for gram in self.ngrams(name):
+                self.postings[gram].add(i)
+
+    def ngrams(self, text: str) -> Set[str]:
+        padded = f"{' ' * (self.n - 1)}{text.lower()} "
+        return {padded[i:i + self.n] for i in range(len(padded) - self.n + 1)}
+
+    def candidates(self, query: str, limit: int = 20) -> List[str]:
+        shared = Counter()
+        for gram in self.ngrams(query):
+            shared.update(self.postings.get(gram, ()))
+
+        return [self.names[i] for i, _ in shared.most_common(limit)]
+
+    def close_matches(self, query: str, n: int = 3, cutoff: float = 0.6) -> List[str]:
+        return difflib.get_close_matches(query, self.candidates(query), n, cutoff)
+
+
+class CommandIndex():
+    """Fuzzy lookup indexes for a bot's commands and cogs.
+    These are built from whatever is loaded at the time, so they should be rebuilt when extensions change."""
+
+    def __init__(self, bot: commands.Bot):
+        self.commands = {command.qualified_name: command for command in bot.walk_commands()}
+        self.command_names = NgramIndex(self.commands)
+        self.cog_names = NgramIndex(bot.cogs)
+
+    def suggest_commands(self, query: str, n: int = 10) -> List[commands.Command]:
+        return [self.commands[name] for name in self.command_names.close_matches(query, n)]
+
+    def suggest_cogs(self, query: str) -> List[str]:
+        return self.cog_names.close_matches(query)
@@ -0,0 +1,120 @@
+import types
+
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import toml
+
+# the entry in items.toml that stands in for anything that isn't in there
+UNKNOWN_ITEM = "item 404"
+
+
+class Record():
+    """A read-only record. Attributes are set once by the constructor, and can't be changed after that."""
+
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError(f"{type(self).__name__} objects are read-only")
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({values})"
+
+
+class Tool(Record):
+    __slots__ = ("tool_type", "durability", "strength")
+
+
+class Recipe(Record):
+    """How to craft an item. names and amounts line up with each other, so that they can be passed straight along
+    to the craft_item function in the DB."""
+
+    __slots__ = ("product", "makes", "made_with", "names", "amounts")
+
+    @property
+    def ingredients(self) -> Dict[str, int]:
+        return dict(zip(self.names, self.amounts))
+
+
+class Item(Record):
+    __slots__ = ("name", "value", "description", "tool", "recipe")
+
+    @property
+    def durability(self) -> int:
+        return self.tool.durability if self.tool else 0
+
+
+class ItemCatalog():
+    """Every item from items.toml, compiled once into read-only records and indexes.
+    recipes_by_workbench maps the name of a workbench (or None for no workbench) to the recipes made with it.
+    tools_by_type maps a type of tool to the tools of that type, strongest first."""
+
+    def __init__(self, data: Mapping[str, Mapping[str, Any]]):
+        items = {name: self.compile_item(name, entry) for name, entry in data.items()}
+        self.unknown = items[UNKNOWN_ITEM]
+        self.items = types.MappingProxyType(items)
+
+        recipes = {}  # type: Dict[Optional[str], List[Recipe]]
+        tools = {}  # type: Dict[str, List[Item]]
+        for item in items.values():
+            if item.recipe:
+                recipes.setdefault(item.recipe.made_with, []).append(item.recipe)
+
+            if item.tool:
+                tools.setdefault(item.tool.tool_type, []).append(item)
+
+        self.recipes_by_workbench = types.MappingProxyType({
+            workbench: tuple(workbench_recipes) for workbench, workbench_recipes in recipes.items()
+        })
+
+        self.tools_by_type = types.MappingProxyType({
+            tool_type: tuple(sorted(type_tools, key=lambda item: item.tool.strength, reverse=True))
+            for tool_type, type_tools in tools.items()
+        })
+
+    @staticmethod
+    def compile_item(name: str, entry: Mapping[str, Any]) -> Item:
+        tool = None
+        if entry.get("tool", {}).get("tool"):
+            tool = Tool(
+                tool_type=entry["tool"]["tool_type"],
+                durability=entry["tool"]["durability"] or 0,
+                strength=entry["tool"]["strength"] or 0
+            )
+
+        recipe = None
+        if entry.get("crafting"):
+            ingredients = entry["crafting"]["ingredients"]  # type: List[Dict[str, Any]]
+            recipe = Recipe(
+                product=name,
+                makes=entry["crafting"]["makes"],
+                made_with=entry["crafting"]["made_with"] or None,
+                names=tuple(ingredient["name"] for ingredient in ingredients),
+                amounts=tuple(ingredient["amount"] for ingredient in ingredients)
+            )
+
+        return Item(
+            name=name, value=entry["value"] or 0, description=entry["description"] or None, tool=tool, recipe=recipe
+        )
+
+    @classmethod
+    def load(cls, filepath: str) -> "ItemCatalog":
+        with open(filepath) as tomlfile:
+            return cls(toml.load(tomlfile))
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.items
+
+    def __getitem__(self, name: str) -> Item:
+        """Returns an item by name, or the stand-in item if there isn't one with that name."""
+
+        return self.items.get(name, self.unknown)
+
+    def recipes_for(self, workbenches: Tuple[Optional[str], ...]) -> List[Recipe]:
+        """Returns every recipe that can be made with any of the given workbenches (None meaning no workbench)."""
+
+        return [recipe for workbench in workbenches for recipe in self.recipes_by_workbench.get(workbench, ())]
@@ -0,0 +1,453 @@
+import os
+import sys
+import json
+import mmap
+import array
+import bisect
+import random
+import struct
+import asyncio
+import itertools
+import logging
+import collections
+
+from typing import Callable, Optional, List, Dict, Tuple
+
+import markovify
+
+
+class SentencePool():
+    """A bounded pool of pre-generated markov sentences.
+    The generate parameter should be a blocking function that returns a single sentence, or None on failure.
+    Sentences are generated in batches in an executor by fill(), which tops the pool up whenever it is drawn from.
+    take() never blocks; it returns None if the pool can't satisfy the request, so the caller can fall back."""
+
+    def __init__(self, generate: Callable[[], Optional[str]], size: int = 60, batch_size: int = 10):
+        self.generate = generate
+        self.size = size
+        self.batch_size = batch_size
+        self.sentences = collections.deque(maxlen=size)
+        self._wanted = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.sentences)
+
+    def _generate_batch(self) -> List[str]:
+        return [sentence for sentence in (self.generate() for _ in range(self.batch_size)) if sentence]
+
+    def take(self, count: int) -> Optional[List[str]]:
+        self._wanted.set()
+        if len(self.sentences) < count:
+            return None
+
+        return [self.sentences.popleft() for _ in range(count)]
+
+    async def fill(self, loop: asyncio.AbstractEventLoop, executor=None) -> None:
+        while True:
+            while len(self.sentences) < self.size:
+                batch = await loop.run_in_executor(executor, self._generate_batch)
+                if not batch:  # the model can't make anything short enough, don't spin on it
+                    await asyncio.sleep(30)
+
+                self.sentences.extend(batch)
+
+            self._wanted.clear()
+            await self._wanted.wait()
+
+
+class CompactChain():
+    """A read-only markov chain stored in a compact binary format.
+    Tokens are interned into a single UTF-8 blob, states are integer IDs, and every edge stores its token,
+    the ID of the state it leads to and a cumulative weight. Walking the chain is therefore just bisecting
+    over an edge range and following an index, with no dictionaries or tuple hashing involved.
+
+    Chains are written with CompactChain.write() and opened with CompactChain.load(), which memory-maps the file.
+    Since the mapping is read-only, multiple processes loading the same file will share the same pages.
+    This has the same make_sentence/ make_short_sentence interface as a markovify model."""
+
+    MAGIC = b"LBMC"
+    VERSION = 1
+    NO_STATE = 0xFFFFFFFF
+    HEADER = struct.Struct("<4sIIIIIII")  # magic, version, state size, tokens, states, edges, begin state, blob size
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        magic, version, self.state_size, token_count, state_count, edge_count, self.begin, blob_size = (
+            self.HEADER.unpack_from(view)
+        )
+
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("Not a compact chain, or a chain from an incompatible version.")
+
+        if sys.byteorder != "little":
+            raise ValueError("Compact chains can only be loaded on little-endian machines.")
+
+        def section(offset, count):
+            return view[offset:offset + count * 4].cast("I"), offset + count * 4
+
+        offset = self.HEADER.size
+        self._token_offsets, offset = section(offset, token_count + 1)
+        self._state_offsets, offset = section(offset, state_count + 1)
+        self._edge_tokens, offset = section(offset, edge_count)
+        self._edge_next, offset = section(offset, edge_count)
+        self._edge_weights, offset = section(offset, edge_count)
+        self._blob = view[offset:offset + blob_size]
+
+    @classmethod
+    def load(cls, path: str) -> "CompactChain":
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return cls(mapped)
+
+    @classmethod
+    def write(cls, chain, path: str) -> None:
+        """Writes a markovify Chain (compiled or not) to path in the compact format."""
+
+        begin_state = tuple([markovify.chain.BEGIN] * chain.state_size)
+        state_ids = {state: i for i, state in enumerate(chain.model)}
+        tokens = {}  # type: Dict[str, int]
+
+        def intern(token):
+            return tokens.setdefault(token, len(tokens))
+
+        state_offsets = array.array("I", [0])
+        edge_tokens, edge_next, edge_weights = array.array("I"), array.array("I"), array.array("I")
+        for state, transitions in chain.model.items():
+            if isinstance(transitions, dict):  # not compiled
+                words, cumulative = list(transitions), list(itertools.accumulate(transitions.values()))
+            else:
+                words, cumulative = transitions
+
+            for word, weight in zip(words, cumulative):
+                if word == markovify.chain.END:
+                    edge_tokens.append(cls.NO_STATE)
+                    edge_next.append(cls.NO_STATE)
+                else:
+                    edge_tokens.append(intern(word))
+                    edge_next.append(state_ids.get(state[1:] + (word, ), cls.NO_STATE))
+
+                edge_weights.append(weight)
+
+            state_offsets.append(len(edge_tokens))
+
+        blob = bytearray()
+        token_offsets = array.array("I", [0])
+        for token in tokens:
+            blob += token.encode("utf-8", errors="ignore")
+            token_offsets.append(len(blob))
+
+        sections = [token_offsets, state_offsets, edge_tokens, edge_next, edge_weights]
+        if sys.byteorder != "little":
+            for section in sections:
+                section.byteswap()
+
+        header = cls.HEADER.pack(
+            cls.MAGIC, cls.VERSION, chain.state_size, len(tokens), len(state_ids),
+            len(edge_tokens), state_ids[begin_state], len(blob)
+        )
+
+        # write to a temporary file first so that a half-written chain is never picked up
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(header)
+            for section in sections:
+                f.write(section.tobytes())
+
+            f.write(blob)
+
+        os.replace(f"{path}.tmp", path)
+
+    def token(self, token_id: int) -> str:
+        return str(self._blob[self._token_offsets[token_id]:self._token_offsets[token_id + 1]], "utf-8")
+
+    def walk(self) -> List[str]:
+        words = []
+        state = self.begin
+        while state != self.NO_STATE:
+            start, end = self._state_offsets[state], self._state_offsets[state + 1]
+            if start == end:  # no way out of this state
+                break
+
+            r = random.random() * self._edge_weights[end - 1]
+            edge = min(bisect.bisect(self._edge_weights, r, start, end), end - 1)
+            if self._edge_tokens[edge] != self.NO_STATE:
+                words.append(self.token(self._edge_tokens[edge]))
+
+            state = self._edge_next[edge]
+
+        return words
+
+    def make_sentence(self, tries: int = 10) -> Optional[str]:
+        for _ in range(tries):
+            words = self.walk()
+            if words:
+                return " ".join(words)
+
+        return None
+
+    def make_short_sentence(self, max_chars: int, min_chars: int = 0, tries: int = 10) -> Optional[str]:
+        for _ in range(tries):
+            sentence = self.make_sentence()
+            if sentence and min_chars <= len(sentence) <= max_chars:
+                return sentence
+
+        return None
+
+
+def load_compact_chain(filepath: str, logger: logging.Logger) -> CompactChain:
+    """Loads the compact chain for a corpus, building it first if it doesn't exist yet.
+    This is blocking and can take a long time for a cold build, so it should be run in an executor."""
+
+    # check if we have a compact model available
+    if not os.path.isfile(filepath + ".chain"):
+        # check if we have a frozen model from an older version available
+        if os.path.isfile(filepath + ".generated"):
+            logger.info("Pre-generated model found! Converting...")
+            with open(filepath + ".generated", "r", encoding="utf-8", errors="ignore") as f:
+                model = markovify.NewlineText.from_json(f.read())
+        else:
+            # no frozen model, generate
+            logger.info("Generating markov model! This may take a while.")
+            with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
+                model = markovify.NewlineText(f, retain_original=False, state_size=2)
+
+            logger.info("Model generated.")
+
+        CompactChain.write(model.chain, filepath + ".chain")
+        logger.info("Saved compact model for future usage.")
+
+    return CompactChain.load(filepath + ".chain")
+
+
+class GuildChain():
+    """A small markov chain that is trained incrementally from messages.
+    The chain is kept under a hard budget of edges: if ingesting text pushes it over, the least used edges are
+    forgotten until it's back down to 90% of the budget. Walking picks each word by bisecting cumulative weights,
+    which are worked out the first time a state is walked through after it last changed."""
+
+    def __init__(self, state_size: int = 2, budget: int = 50000):
+        self.state_size = state_size
+        self.budget = budget
+        self.model = {}  # type: Dict[Tuple[str, ...], Dict[str, int]]
+        self.size = 0
+        self._choices = {}  # type: Dict[Tuple[str, ...], Tuple[List[str], List[int]]]
+
+    def ingest(self, text: str) -> None:
+        for line in text.splitlines():
+            words = line.split()
+            if not words:
+                continue
+
+            state = tuple([markovify.chain.BEGIN] * self.state_size)
+            for word in words + [markovify.chain.END]:
+                edges = self.model.setdefault(state, {})
+                if word in edges:
+                    edges[word] += 1
+                else:
+                    edges[word] = 1
+                    self.size += 1
+
+                self._choices.pop(state, None)
+                state = state[1:] + (word, )
+
+        if self.size > self.budget:
+            self.compact()
+
+    def compact(self) -> None:
+        """Trims the chain to 90% of its budget in one go, forgetting the least used edges first.
+        Most edges have only been seen once, so anything that shrinks every count would forget most of the chain."""
+
+        if self.size <= self.budget:
+            return
+
+        # find the count that edges need to be above to survive - every edge below it goes, and as many with it as
+        # are needed to get down to the target
+        excess = self.size - int(self.budget * 0.9)
+        counts = collections.Counter(count for edges in self.model.values() for count in edges.values())
+        threshold, below = 0, 0
+        for threshold in sorted(counts):
+            if below + counts[threshold] >= excess:
+                break
+
+            below += counts[threshold]
+
+        at_threshold = excess - below
+        self._choices.clear()
+        for state in list(self.model):
+            edges = self.model[state]
+            for word in list(edges):
+                if edges[word] == threshold and at_threshold > 0:
+                    at_threshold -= 1
+                elif edges[word] >= threshold:
+                    continue
+
+                del edges[word]
+                self.size -= 1
+
+            if not edges:
+                del self.model[state]
+
+        self.prune()
+
+    def prune(self) -> None:
+        """Forgets states that can no longer be reached from the start of a sentence."""
+
+        reachable = set()
+        pending = [tuple([markovify.chain.BEGIN] * self.state_size)]
+        while pending:
+            state = pending.pop()
+            if state in reachable or state not in self.model:
+                continue
+
+            reachable.add(state)
+            pending.extend(state[1:] + (word, ) for word in self.model[state] if word != markovify.chain.END)
+
+        for state in list(self.model):
+            if state not in reachable:
+                self.size -= len(self.model.pop(state))
+
+    def walk(self, max_words: int = 64) -> List[str]:
+        words = []
+        state = tuple([markovify.chain.BEGIN] * self.state_size)
+        while len(words) < max_words and state in self.model:
+            choices = self._choices.get(state)
+            if choices is None:
+                edges = self.model[state]
+                choices = self._choices[state] = (list(edges), list(itertools.accumulate(edges.values())))
+
+            choice_words, weights = choices
+            word = choice_words[bisect.bisect(weights, random.random() * weights[-1])]
+            if word == markovify.chain.END:
+                break
+
+            words.append(word)
+            state = state[1:] + (word, )
+
+        return words
+
+    def make_sentence(self, tries: int = 10) -> Optional[str]:
+        for _ in range(tries):
+            words = self.walk()
+            if words:
+                return " ".join(words)
+
+        return None
+
+    def make_short_sentence(self, max_chars: int, min_chars: int = 0, tries: int = 10) -> Optional[str]:
+        for _ in range(tries):
+            sentence = self.make_sentence()
+            if sentence and min_chars <= len(sentence) <= max_chars:
+                return sentence
+
+        return None
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "state_size": self.state_size,
+            "model": [[list(state), edges] for state, edges in self.model.items()]
+        })
+
+    @classmethod
+    def from_json(cls, data: str, **kwargs) -> "GuildChain":
+        parsed = json.loads(data)
+        chain = cls(state_size=parsed["state_size"], **kwargs)
+        for state, edges in parsed["model"]:
+            chain.model[tuple(state)] = edges
+            chain.size += len(edges)
+
+        chain.compact()  # the budget may have been lowered since this was saved
+        return chain
+
+
+class GuildChains():
+    """Keeps a GuildChain for each guild, up to a maximum number of guilds.
+    When that maximum is exceeded, the least recently used guild's chain is saved to disk and evicted.
+    Chains are persisted to the given directory as JSON, and loaded back from it the next time they're used.
+    Reading, parsing and writing files happens in an executor - only snapshotting a chain is done on the loop."""
+
+    def __init__(self, directory: str, max_guilds: int = 100, budget: int = 50000):
+        self.directory = directory
+        self.max_guilds = max_guilds
+        self.budget = budget
+        self.chains = collections.OrderedDict()  # type: collections.OrderedDict[int, GuildChain]
+        self.dirty = set()
+        self.writes = {}  # type: Dict[int, asyncio.Future]
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, guild_id: int) -> str:
+        return os.path.join(self.directory, f"{guild_id}.json")
+
+    def read(self, guild_id: int) -> GuildChain:
+        try:
+            with open(self.path(guild_id), "r", encoding="utf-8") as f:
+                return GuildChain.from_json(f.read(), budget=self.budget)
+        except (OSError, ValueError, KeyError):
+            return GuildChain(budget=self.budget)
+
+    def write(self, guild_id: int, data: str) -> None:
+        # write to a temporary file first so that a half-written chain is never picked up
+        with open(f"{self.path(guild_id)}.tmp", "w", encoding="utf-8") as f:
+            f.write(data)
+
+        os.replace(f"{self.path(guild_id)}.tmp", self.path(guild_id))
+
+    def peek(self, guild_id: int) -> Optional[GuildChain]:
+        """Returns a guild's chain if it's already loaded, without loading, creating or evicting anything."""
+
+        return self.chains.get(guild_id)
+
+    async def get(self, guild_id: int, loop: asyncio.AbstractEventLoop, executor=None) -> GuildChain:
+        if guild_id in self.chains:
+            self.chains.move_to_end(guild_id)
+            return self.chains[guild_id]
+
+        # if this chain is still being written out after an eviction, the file isn't up to date yet
+        if guild_id in self.writes:
+            await asyncio.wait([self.writes[guild_id]])
+
+        chain = await loop.run_in_executor(executor, self.read, guild_id)
+        if guild_id in self.chains:  # loaded by someone else while we were reading
+            return self.chains[guild_id]
+
+        self.chains[guild_id] = chain
+        while len(self.chains) > self.max_guilds:
+            evicted_id, _ = next(iter(self.chains.items()))
+            save = self.save(evicted_id, loop, executor)  # snapshots the chain straight away
+            del self.chains[evicted_id]
+            await save
+
+        return chain
+
+    async def ingest(self, guild_id: int, text: str, loop: asyncio.AbstractEventLoop, executor=None) -> None:
+        chain = await self.get(guild_id, loop, executor)
+        chain.ingest(text)
+        self.dirty.add(guild_id)
+
+    def save(self, guild_id: int, loop: asyncio.AbstractEventLoop, executor=None) -> asyncio.Future:
+        """Snapshots a guild's chain if it has changed, then writes it out in the executor.
+        Returns a future for the write, so callers can free the chain without waiting for it."""
+
+        if guild_id not in self.dirty:
+            future = loop.create_future()
+            future.set_result(None)
+            return future
+
+        data = self.chains[guild_id].to_json()
+        self.dirty.discard(guild_id)
+        future = self.writes[guild_id] = loop.run_in_executor(executor, self.write, guild_id, data)
+
+        def done(_):
+            if self.writes.get(guild_id) is future:
+                del self.writes[guild_id]
+
+        future.add_done_callback(done)
+        return future
+
+    async def save_all(self, loop: asyncio.AbstractEventLoop, executor=None) -> None:
+        for guild_id in list(self.dirty):
+            await self.save(guild_id, loop, executor)
+
+    async def persist(self, loop: asyncio.AbstractEventLoop, executor=None, interval: float = 300) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.save_all(loop, executor)
@@ -0,0 +1,352 @@
+import asyncio
+import itertools
+import collections
+
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import pendulum
+
+from . import queryclasses, metricsclasses
+
+
+class MemoryTable():
+    """A table kept in memory, with the same interface as a bigbeans table.
+    Every row gets an _id like it would in postgres. Lookups go through hash indexes on the columns being filtered
+    on - an index is built the first time a set of columns is filtered on, and kept up to date from then on."""
+
+    def __init__(self, databean: "MemoryDatabean", name: str):
+        self.databean = databean
+        self.name = name
+        self.rows = {}  # type: Dict[int, Dict[str, Any]]
+        self.indexes = {}  # type: Dict[Tuple[str, ...], Dict[Tuple, Set[int]]]
+        self._ids = itertools.count(1)
+
+    def _index(self, columns: Tuple[str, ...]) -> Dict[Tuple, Set[int]]:
+        try:
+            return self.indexes[columns]
+        except KeyError:
+            index = self.indexes[columns] = collections.defaultdict(set)
+            for row_id, row in self.rows.items():
+                index[tuple(row.get(column) for column in columns)].add(row_id)
+
+            return index
+
+    def select(self, **filters) -> List[Dict[str, Any]]:
+        """Returns the rows matching every filter, in the order that they were inserted."""
+
+        if not filters:
+            return list(self.rows.values())
+
+        if tuple(filters) == ("_id", ):
+            row = self.rows.get(filters["_id"])
+            return [row] if row is not None else []
+
+        columns = tuple(sorted(filters))
+        row_ids = self._index(columns).get(tuple(filters[column] for column in columns), ())
+        return [self.rows[row_id] for row_id in sorted(row_ids)]
+
+    def add(self, **values) -> Dict[str, Any]:
+        row = dict(values, _id=next(self._ids))
+        self.rows[row["_id"]] = row
+        for columns, index in self.indexes.items():
+            index[tuple(row.get(column) for column in columns)].add(row["_id"])
+
+        return row
+
+    def change(self, row: Dict[str, Any], **values) -> None:
+        for columns, index in self.indexes.items():
+            if any(column in values for column in columns):
+                index[tuple(row.get(column) for column in columns)].discard(row["_id"])
+                index[tuple(values.get(column, row.get(column)) for column in columns)].add(row["_id"])
+
+        row.update(values)
+
+    def remove(self, rows: Iterable[Dict[str, Any]]) -> int:
+        removed = 0
+        for row in list(rows):
+            for columns, index in self.indexes.items():
+                index[tuple(row.get(column) for column in columns)].discard(row["_id"])
+
+            del self.rows[row["_id"]]
+            removed += 1
+
+        return removed
+
+    # the bigbeans interface - these return copies, so that callers can't change rows behind the table's back
+
+    async def find(self, **filters) -> List[Dict[str, Any]]:
+        await self.databean.wait(f"{self.name}.find")
+        return [dict(row) for row in self.select(**filters)]
+
+    async def find_one(self, **filters) -> Optional[Dict[str, Any]]:
+        await self.databean.wait(f"{self.name}.find_one")
+        rows = self.select(**filters)
+        return dict(rows[0]) if rows else None
+
+    async def insert(self, **values) -> None:
+        await self.databean.wait(f"{self.name}.insert")
+        self.add(**values)
+
+    async def upsert(self, keys: Sequence[str], **values) -> None:
+        await self.databean.wait(f"{self.name}.upsert")
+        rows = self.select(**{key: values[key] for key in keys})
+        if not rows:
+            self.add(**values)
+
+        for row in rows:
+            self.change(row, **values)
+
+    async def delete(self, **filters) -> None:
+        await self.databean.wait(f"{self.name}.delete")
+        self.remove(self.select(**filters))
+
+
+class MemoryDatabean():
+    """An in-process stand-in for a bigbeans Databean, for benchmarking and testing without postgres.
+    Tables are created the first time they're used. Every call is counted by operation in calls, and waits for
+    latency seconds first so that the bot can be benchmarked with realistic DB round trips.
+    Only the table methods are supported - there's no fetch_query or execute_query, since raw SQL can't run here.
+    Named statements run through MemoryStatementRegistry, and migrations are skipped because there's no schema."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.tables = {}  # type: Dict[str, MemoryTable]
+        self.calls = collections.Counter()  # type: collections.Counter
+
+    def __getitem__(self, name: str) -> MemoryTable:
+        try:
+            return self.tables[name]
+        except KeyError:
+            table = self.tables[name] = MemoryTable(self, name)
+            return table
+
+    async def wait(self, operation: str) -> None:
+        self.calls[operation] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)  # still yield, like a real query would
+
+
+class MemoryStatementRegistry():
+    """Runs the named statements from queryclasses against a MemoryDatabean, with the same results and interface as
+    StatementRegistry. Each statement is a method named after it that returns a list of rows, and runs without
+    yielding to the event loop - so statements are exactly as atomic here as they are in postgres."""
+
+    def __init__(self, databean: MemoryDatabean):
+        self.databean = databean
+        missing = [name for name in queryclasses.STATEMENTS if not hasattr(self, f"_{name}")]
+        if missing:
+            raise NotImplementedError(f"No in-memory version of statements: {', '.join(missing)}")
+
+    async def _run(self, name: str, args) -> List[Dict[str, Any]]:
+        with metricsclasses.timed("db"):
+            await self.databean.wait(name)
+            return getattr(self, f"_{name}")(*args)
+
+    async def fetch(self, name: str, *args) -> List[Dict[str, Any]]:
+        return [dict(row) for row in await self._run(name, args)]
+
+    async def fetchrow(self, name: str, *args) -> Optional[Dict[str, Any]]:
+        results = await self._run(name, args)
+        return dict(results[0]) if results else None
+
+    async def fetchval(self, name: str, *args) -> Any:
+        results = await self._run(name, args)
+        return next(iter(results[0].values())) if results else None
+
+    async def execute(self, name: str, *args) -> None:
+        await self._run(name, args)
+
+    # inventory and inventory_stacks
+
+    def _owned(self, user_id: int, name: str) -> int:
+        stacks = self.databean["inventory_stacks"].select(user_id=user_id, name=name)
+        return sum(row["count"] for row in stacks) + len(self.databean["inventory"].select(user_id=user_id, name=name))
+
+    def _add_to_stack(self, user_id: int, name: str, count: int) -> None:
+        stacks = self.databean["inventory_stacks"]
+        rows = stacks.select(user_id=user_id, name=name)
+        if rows:
+            stacks.change(rows[0], count=rows[0]["count"] + count)
+        else:
+            stacks.add(user_id=user_id, name=name, count=count)
+
+    def _inventory_add_many(self, user_id: int, names: List[str], counts: List[int], durabilities: List[int]):
+        for name, count, durability in zip(names, counts, durabilities):
+            if durability == 0:
+                self._add_to_stack(user_id, name, count)
+            else:
+                for _ in range(count):
+                    self.databean["inventory"].add(user_id=user_id, name=name, durability=durability)
+
+        return []
+
+    def _inventory_remove(self, user_id: int, name: str, quantity: int):
+        removed = 0
+        stacks = self.databean["inventory_stacks"].select(user_id=user_id, name=name)
+        if stacks:
+            removed = min(stacks[0]["count"], quantity)
+            self.databean["inventory_stacks"].change(stacks[0], count=stacks[0]["count"] - removed)
+
+        items = self.databean["inventory"].select(user_id=user_id, name=name)[:max(quantity - removed, 0)]
+        removed += self.databean["inventory"].remove(items)
+        return [{"removed": removed}]
+
+    def _inventory_counts(self, user_id: int):
+        counts = collections.Counter()  # type: collections.Counter
+        for row in self.databean["inventory_stacks"].select(user_id=user_id):
+            if row["count"] > 0:
+                counts[row["name"]] += row["count"]
+
+        counts.update(row["name"] for row in self.databean["inventory"].select(user_id=user_id))
+        return [{"name": name, "count": counts[name]} for name in sorted(counts)]
+
+    def _inventory_strongest_weapon(self, user_id: int):
+        weapons = []
+        for row in self.databean["inventory"].select(user_id=user_id):
+            for weapon in self.databean["weapon_strength"].select(name=row["name"]):
+                weapons.append(dict(row, strength=weapon["strength"]))
+
+        return sorted(weapons, key=lambda weapon: (-weapon["strength"], weapon["_id"]))[:1]
+
+    def _inventory_wear_item(self, item_id: int, amount: int):
+        removed = []
+        for row in self.databean["inventory"].select(_id=item_id):
+            if row["durability"] <= amount:
+                self.databean["inventory"].remove([row])
+                removed.append({"user_id": row["user_id"], "name": row["name"]})
+            else:
+                self.databean["inventory"].change(row, durability=row["durability"] - amount)
+
+        return removed
+
+    def _craft(self, user_id: int, names: List[str], amounts: List[int], workbench: Optional[str],
+               product: str, makes: int, durability: int, minutes: int, starting_time: int, day_length: int):
+        owned = [self._owned(user_id, name) for name in names]
+        has_workbench = workbench is None or self._owned(user_id, workbench) > 0
+        crafted = has_workbench and all(count >= amount for count, amount in zip(owned, amounts))
+        result = {"crafted": crafted, "has_workbench": has_workbench, "owned": owned, "current_minutes": None}
+        if not crafted:
+            return [result]
+
+        for name, amount in zip(names, amounts):
+            self._inventory_remove(user_id, name, amount)
+
+        self._inventory_add_many(user_id, [product], [makes], [durability])
+        result["current_minutes"] = self._game_advance_time(user_id, starting_time, minutes, day_length)[0]["minutes"]
+        return [result]
+
+    def _weapon_strength_sync(self, names: List[str], strengths: List[int]):
+        table = self.databean["weapon_strength"]
+        table.remove([row for row in table.select() if row["name"] not in names])
+        for name, strength in zip(names, strengths):
+            rows = table.select(name=name)
+            if rows:
+                table.change(rows[0], strength=strength)
+            else:
+                table.add(name=name, strength=strength)
+
+        return []
+
+    # currency
+
+    def _currency_balance(self, user_id: int):
+        return [{"amount": row["amount"]} for row in self.databean["currency"].select(user_id=user_id)]
+
+    def _currency_add(self, user_id: int, amount: int):
+        rows = self.databean["currency"].select(user_id=user_id)
+        if rows:
+            self.databean["currency"].change(rows[0], amount=rows[0]["amount"] + amount)
+        else:
+            rows = [self.databean["currency"].add(user_id=user_id, amount=amount)]
+
+        return [{"amount": rows[0]["amount"]}]
+
+    def _currency_spend(self, user_id: int, amount: int):
+        rows = [row for row in self.databean["currency"].select(user_id=user_id) if row["amount"] >= amount]
+        for row in rows:
+            self.databean["currency"].change(row, amount=row["amount"] - amount)
+
+        return [{"amount": row["amount"]} for row in rows]
+
+    def _currency_all(self):
+        return [{"user_id": row["user_id"], "amount": row["amount"]} for row in self.databean["currency"].select()]
+
+    def _currency_guild_add(self, user_id: int, guild_id: int):
+        if not self.databean["currency_guilds"].select(user_id=user_id, guild_id=guild_id):
+            self.databean["currency_guilds"].add(user_id=user_id, guild_id=guild_id)
+
+        return []
+
+    def _currency_guilds_all(self):
+        rows = self.databean["currency_guilds"].select()
+        return [{"user_id": row["user_id"], "guild_id": row["guild_id"]} for row in rows]
+
+    # game_time
+
+    def _game_time(self, user_id: int):
+        return [{"minutes": row["minutes"]} for row in self.databean["game_time"].select(user_id=user_id)]
+
+    def _game_set_time(self, user_id: int, minutes: int):
+        self.databean["game_time"].remove(self.databean["game_time"].select(user_id=user_id))
+        self.databean["game_time"].add(user_id=user_id, minutes=minutes)
+        return []
+
+    def _game_advance_time(self, user_id: int, starting_time: int, minutes: int, day_length: int):
+        rows = self.databean["game_time"].select(user_id=user_id)
+        if rows:
+            self.databean["game_time"].change(rows[0], minutes=(rows[0]["minutes"] + minutes) % day_length)
+        else:
+            rows = [self.databean["game_time"].add(user_id=user_id, minutes=(starting_time + minutes) % day_length)]
+
+        return [{"minutes": rows[0]["minutes"]}]
+
+    # extended_cooldown
+
+    def _cooldown_last_accessed(self, unique_id: int, cooldown_group: str):
+        rows = self.databean["extended_cooldown"].select(unique_id=unique_id, cooldown_group=cooldown_group)
+        return [{"last_accessed": row["last_accessed"]} for row in rows]
+
+    def _cooldown_set(self, unique_id: int, cooldown_group: str, last_accessed: pendulum.DateTime):
+        table = self.databean["extended_cooldown"]
+        rows = table.select(unique_id=unique_id, cooldown_group=cooldown_group)
+        if rows:
+            table.change(rows[0], last_accessed=last_accessed)
+        else:
+            table.add(unique_id=unique_id, cooldown_group=cooldown_group, last_accessed=last_accessed)
+
+        return []
+
+    # action_counts
+
+    def _action_count(self, user_id: int, action: str):
+        rows = self.databean["action_counts"].select(user_id=user_id, action=action)
+        return [{"amount": row["amount"]} for row in rows]
+
+    def _action_count_add_many(self, user_ids: List[int], actions: List[str], amounts: List[int]):
+        table = self.databean["action_counts"]
+        for user_id, action, amount in zip(user_ids, actions, amounts):
+            rows = table.select(user_id=user_id, action=action)
+            if rows:
+                table.change(rows[0], amount=rows[0]["amount"] + amount)
+            else:
+                table.add(user_id=user_id, action=action, amount=amount)
+
+        return []
+
+    # channel_locks
+
+    def _channel_locks(self, guild_id: int):
+        return [{"channel_id": row["channel_id"]} for row in self.databean["channel_locks"].select(guild_id=guild_id)]
+
+    def _channel_lock_add(self, guild_id: int, channel_id: int):
+        if not self.databean["channel_locks"].select(guild_id=guild_id, channel_id=channel_id):
+            self.databean["channel_locks"].add(guild_id=guild_id, channel_id=channel_id)
+
+        return []
+
+    def _channel_lock_remove(self, guild_id: int, channel_id: int):
+        table = self.databean["channel_locks"]
+        table.remove(table.select(guild_id=guild_id, channel_id=channel_id))
+        return []
@@ -62,6 +62,64 @@ class ListPageMenu(menus.ListPageSource):
         return embed
 
 
+class LazyEmbedPageMenu(menus.PageSource):
+    """A menu class for embeds that are expensive to build.
+    The first page is given up front, and every other page is built from an item in data when it's first navigated to.
+    The build parameter should be a coroutine function that takes an item and returns an embed, or None to skip it.
+    If the formatter parameter is given, it's used in the same way as with EmbedPageMenu."""
+
+    def __init__(self, first_page: discord.Embed, data, build, formatter=None):
+        self.pages = [first_page]
+        self.pending = list(data)
+        self.build = build
+        if formatter is not None:
+            if inspect.isfunction(formatter):
+                self.formatter = formatter
+            else:
+                raise TypeError(f"Formatter parameter must be a function, not object of type {type(formatter)}")
+        else:
+            self.formatter = None
+
+    def is_paginating(self):
+        return True
+
+    def get_max_pages(self):
+        # until everything has been built, we don't know how many pages will be skipped
+        return None if self.pending else len(self.pages)
+
+    async def get_page(self, page_number):
+        if page_number < 0:
+            raise IndexError("Page number out of range.")
+
+        while page_number >= len(self.pages) and self.pending:
+            page = await self.build(self.pending.pop(0))
+            if page is not None:
+                self.pages.append(page)
+
+        return self.pages[page_number]
+
+    async def format_page(self, menu, entries: discord.Embed):
+        if self.formatter:
+            adjusted = self.formatter(entries, self, menu)
+            return adjusted or entries
+
+        return entries
+
+
+def lazy_title_page_number_formatter(title):
+
+    def formatter(embed, pages, menu):
+        max_pages = pages.get_max_pages()
+        if max_pages is None:
+            embed.title = f"{title} (page {menu.current_page + 1})"
+        else:
+            embed.title = f"{title} (page {menu.current_page + 1}/{max_pages})"
+
+        return embed
+
+    return formatter
+
+
 def title_page_number_formatter(title):
 
     def formatter(embed, pages, menu):
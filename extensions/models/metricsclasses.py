@@ -0,0 +1,247 @@
+import sys
+import time
+import bisect
+import asyncio
+import threading
+import traceback
+import contextlib
+import contextvars
+
+from collections import defaultdict, deque
+from typing import Dict, Optional, Iterator, List
+
+# upper bounds of histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# "total" is the whole invocation, everything else is the time spent waiting on that thing during the invocation
+PHASES = ("total", "db", "executor", "send")
+
+_current_invocation = contextvars.ContextVar("current_invocation", default=None)  # type: contextvars.ContextVar
+
+
+class Histogram():
+    """A fixed-bucket latency histogram, in the same shape that prometheus expects."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Returns the upper bound of the bucket that the given quantile falls in."""
+
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+
+        return float("inf")
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+
+class Invocation():
+    """The time spent in, and the number of waits on, each phase of a single command invocation."""
+
+    def __init__(self):
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.waits = dict.fromkeys(PHASES, 0)
+
+
+class CommandStats():
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.latency = {phase: Histogram() for phase in PHASES}
+        self.waits = dict.fromkeys(PHASES, 0)
+
+    def waits_per_invocation(self, phase: str) -> float:
+        return self.waits[phase] / self.count if self.count else 0.0
+
+
+class CommandMetrics():
+    """Per-command invocation counts, error counts and latency histograms.
+    start() and finish() should wrap a command invocation - anything inside that uses timed() is attributed to it."""
+
+    def __init__(self):
+        self.commands = defaultdict(CommandStats)  # type: Dict[str, CommandStats]
+
+    def start(self):
+        invocation = Invocation()
+        return _current_invocation.set(invocation), invocation
+
+    def finish(self, token, invocation: Invocation, name: str, elapsed: float, failed: bool) -> None:
+        _current_invocation.reset(token)
+        stats = self.commands[name]
+        stats.count += 1
+        stats.errors += failed
+        invocation.timings["total"] = elapsed
+        invocation.waits["total"] = 1
+        for phase, value in invocation.timings.items():
+            stats.latency[phase].observe(value)
+            stats.waits[phase] += invocation.waits[phase]
+
+    def render(self) -> str:
+        """Renders everything in the prometheus text exposition format."""
+
+        lines = [
+            "# HELP lobstero_command_invocations_total Number of times a command was invoked.",
+            "# TYPE lobstero_command_invocations_total counter"
+        ]
+
+        lines += [f'lobstero_command_invocations_total{{command="{n}"}} {s.count}' for n, s in self.commands.items()]
+        lines += [
+            "# HELP lobstero_command_errors_total Number of command invocations that failed.",
+            "# TYPE lobstero_command_errors_total counter"
+        ]
+
+        lines += [f'lobstero_command_errors_total{{command="{n}"}} {s.errors}' for n, s in self.commands.items()]
+        lines += [
+            "# HELP lobstero_command_waits_total Number of times commands waited on something, like a DB query.",
+            "# TYPE lobstero_command_waits_total counter"
+        ]
+
+        for name, stats in self.commands.items():
+            lines += [
+                f'lobstero_command_waits_total{{command="{name}",phase="{phase}"}} {waits}'
+                for phase, waits in stats.waits.items() if phase != "total"
+            ]
+
+        lines += [
+            "# HELP lobstero_command_duration_seconds Time spent in a command, split by what it was waiting on.",
+            "# TYPE lobstero_command_duration_seconds histogram"
+        ]
+
+        for name, stats in self.commands.items():
+            for phase, histogram in stats.latency.items():
+                labels = f'command="{name}",phase="{phase}"'
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf", ), histogram.counts):
+                    cumulative += count
+                    lines.append(f'lobstero_command_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+
+                lines.append(f"lobstero_command_duration_seconds_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"lobstero_command_duration_seconds_count{{{labels}}} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """Attributes the time spent inside this block to a phase of the command currently being invoked, if any."""
+
+    invocation = _current_invocation.get()  # type: Optional[Invocation]
+    if invocation is None:
+        yield
+        return
+
+    invocation.waits[phase] += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        invocation.timings[phase] += time.perf_counter() - started
+
+
+class TimedProxy():
+    """Wraps an object so that awaiting any of its coroutine methods is timed as the given phase.
+    Indexing the proxy returns another proxy, so this works for things like a Databean and its tables."""
+
+    def __init__(self, wrapped, phase: str):
+        self._wrapped = wrapped
+        self._phase = phase
+
+    def __getattr__(self, name):
+        attribute = getattr(self._wrapped, name)
+        if not asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        async def wrapper(*args, **kwargs):
+            with timed(self._phase):
+                return await attribute(*args, **kwargs)
+
+        return wrapper
+
+    def __getitem__(self, key):
+        return TimedProxy(self._wrapped[key], self._phase)
+
+
+class LoopLagMonitor():
+    """Measures how late the event loop is to wake up, and catches whatever is blocking it when it stalls.
+    sample() should be run as a task on the loop being monitored. It sleeps for a fixed interval and records
+    how late it wakes up. A watchdog thread notices when the loop hasn't woken up for longer than the threshold,
+    and grabs the loop thread's stack (and the command being invoked, if there is one) while it's still stuck."""
+
+    def __init__(self, interval: float = 0.25, threshold: float = 0.1, history: int = 2400):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = deque(maxlen=history)
+        self.stalls = deque(maxlen=50)
+        self._last_wake = time.monotonic()
+        self._loop_thread_id = None  # type: Optional[int]
+        self._pending_stall = None  # type: Optional[Dict]
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    async def sample(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        threading.Thread(target=self.watch, name="loop-lag-watchdog", daemon=True).start()
+
+        while True:
+            self._last_wake = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - self._last_wake - self.interval)
+            self.samples.append(lag)
+
+            if lag >= self.threshold:
+                stall = self._pending_stall or {"when": time.time(), "command": None, "stack": []}
+                stall["lag"] = lag  # how late the loop woke up, not how long it was blocked for
+                self.stalls.append(stall)
+
+            self._pending_stall = None
+
+    def watch(self) -> None:
+        while True:
+            time.sleep(self.threshold / 2)
+            stalled_for = time.monotonic() - self._last_wake - self.interval
+            if stalled_for < self.threshold or self._pending_stall is not None:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                self._pending_stall = {
+                    "when": time.time(), "command": self.find_command(frame), "stack": traceback.extract_stack(frame)
+                }
+
+    @staticmethod
+    def find_command(frame) -> Optional[str]:
+        """Walks outwards from a frame looking for the context of a command invocation."""
+
+        while frame is not None:
+            ctx = frame.f_locals.get("ctx")
+            command = getattr(ctx, "command", None)
+            if command is not None:
+                return command.qualified_name
+
+            frame = frame.f_back
+
+        return None
+
+    def recent_stalls(self, count: int = 5) -> List[Dict]:
+        return list(self.stalls)[-count:]
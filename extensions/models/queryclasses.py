@@ -0,0 +1,125 @@
+from typing import Any, List, Mapping, Optional
+
+import asyncpg
+
+from . import metricsclasses
+
+# the hot queries, by name
+STATEMENTS = {
+    # inventory and inventory_stacks
+    "inventory_add_many": """WITH stacked AS (
+        INSERT INTO inventory_stacks (user_id, name, count)
+        SELECT $1, item.name, item.count
+        FROM unnest($2::text[], $3::int[], $4::int[]) AS item (name, count, durability)
+        WHERE item.durability = 0
+        ON CONFLICT (user_id, name) DO UPDATE SET count = inventory_stacks.count + EXCLUDED.count
+    )
+    INSERT INTO inventory (user_id, name, durability)
+    SELECT $1, item.name, item.durability
+    FROM unnest($2::text[], $3::int[], $4::int[]) AS item (name, count, durability),
+    generate_series(1, item.count)
+    WHERE item.durability <> 0""",
+    "inventory_remove": """WITH stack AS (
+        UPDATE inventory_stacks AS s SET count = s.count - LEAST(s.count, $3)
+        FROM (SELECT _id, count FROM inventory_stacks WHERE user_id = $1 AND name = $2 FOR UPDATE) AS old
+        WHERE s._id = old._id
+        RETURNING old.count - s.count AS removed
+    ), removed AS (
+        DELETE FROM inventory
+        WHERE _id IN (
+            SELECT _id FROM inventory WHERE user_id = $1 AND name = $2
+            LIMIT GREATEST($3 - COALESCE((SELECT removed FROM stack), 0), 0)
+        )
+        RETURNING 1
+    )
+    SELECT COALESCE((SELECT removed FROM stack), 0) + (SELECT count(*) FROM removed) AS removed""",
+    "inventory_counts": """SELECT name, sum(count)::int AS count FROM (
+        SELECT name, count FROM inventory_stacks WHERE user_id = $1 AND count > 0
+        UNION ALL
+        SELECT name, count(*) FROM inventory WHERE user_id = $1 GROUP BY name
+    ) AS items
+    GROUP BY name ORDER BY name""",
+    "inventory_strongest_weapon": """SELECT inventory.*, weapon_strength.strength
+    FROM inventory JOIN weapon_strength ON weapon_strength.name = inventory.name
+    WHERE inventory.user_id = $1
+    ORDER BY weapon_strength.strength DESC, inventory._id
+    LIMIT 1""",
+    "inventory_wear_item": """WITH removed AS (
+        DELETE FROM inventory WHERE _id = $1 AND durability <= $2 RETURNING user_id, name
+    ), worn AS (
+        UPDATE inventory SET durability = durability - $2 WHERE _id = $1 AND NOT EXISTS (SELECT 1 FROM removed)
+    )
+    SELECT user_id, name FROM removed""",
+    "craft": "SELECT * FROM craft_item($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)",
+    "weapon_strength_sync": """WITH removed AS (
+        DELETE FROM weapon_strength WHERE name <> ALL($1::text[])
+    )
+    INSERT INTO weapon_strength (name, strength) SELECT * FROM unnest($1::text[], $2::int[])
+    ON CONFLICT (name) DO UPDATE SET strength = EXCLUDED.strength""",
+
+    # currency
+    "currency_balance": "SELECT amount FROM currency WHERE user_id = $1",
+    "currency_add": """INSERT INTO currency (user_id, amount) VALUES ($1, $2)
+    ON CONFLICT (user_id) DO UPDATE SET amount = currency.amount + EXCLUDED.amount
+    RETURNING amount""",
+    "currency_spend": "UPDATE currency SET amount = amount - $2 WHERE user_id = $1 AND amount >= $2 RETURNING amount",
+    "currency_all": "SELECT user_id, amount FROM currency",
+    "currency_guild_add": "INSERT INTO currency_guilds (user_id, guild_id) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+    "currency_guilds_all": "SELECT user_id, guild_id FROM currency_guilds",
+
+    # game_time
+    "game_time": "SELECT minutes FROM game_time WHERE user_id = $1",
+    "game_set_time": """INSERT INTO game_time (user_id, minutes) VALUES ($1, $2)
+    ON CONFLICT (user_id) DO UPDATE SET minutes = EXCLUDED.minutes""",
+    "game_advance_time": """INSERT INTO game_time (user_id, minutes)
+    VALUES ($1, (($2::int + $3::int) % $4::int + $4) % $4)
+    ON CONFLICT (user_id) DO UPDATE SET minutes = ((game_time.minutes + $3) % $4 + $4) % $4
+    RETURNING minutes""",
+
+    # extended_cooldown
+    "cooldown_last_accessed": """SELECT last_accessed FROM extended_cooldown
+    WHERE unique_id = $1 AND cooldown_group = $2""",
+    "cooldown_set": """INSERT INTO extended_cooldown (unique_id, cooldown_group, last_accessed) VALUES ($1, $2, $3)
+    ON CONFLICT (unique_id, cooldown_group) DO UPDATE SET last_accessed = EXCLUDED.last_accessed""",
+
+    # action_counts
+    "action_count": "SELECT amount FROM action_counts WHERE user_id = $1 AND action = $2",
+    "action_count_add_many": """INSERT INTO action_counts (user_id, action, amount)
+    SELECT * FROM unnest($1::bigint[], $2::text[], $3::int[])
+    ON CONFLICT (user_id, action) DO UPDATE SET amount = action_counts.amount + EXCLUDED.amount""",
+
+    # channel_locks
+    "channel_locks": "SELECT channel_id FROM channel_locks WHERE guild_id = $1",
+    "channel_lock_add": """INSERT INTO channel_locks (guild_id, channel_id) VALUES ($1, $2)
+    ON CONFLICT (guild_id, channel_id) DO NOTHING""",
+    "channel_lock_remove": "DELETE FROM channel_locks WHERE guild_id = $1 AND channel_id = $2"
+}
+
+
+class StatementRegistry():
+    """Runs statements by name.
+    asyncpg prepares every query it's given once per connection and keeps the prepared statement around, keyed by
+    the query's text - so as long as a statement's text never changes, it's parsed and planned once on each pooled
+    connection and reused from then on. Waiting on the database is timed as the "db" phase of the current command."""
+
+    def __init__(self, pool, statements: Mapping[str, str] = STATEMENTS):
+        self.pool = pool
+        self.statements = dict(statements)
+
+    async def _run(self, method: str, name: str, args) -> Any:
+        query = self.statements[name]
+        with metricsclasses.timed("db"):
+            async with self.pool.acquire() as connection:
+                return await getattr(connection, method)(query, *args)
+
+    async def fetch(self, name: str, *args) -> List[asyncpg.Record]:
+        return await self._run("fetch", name, args)
+
+    async def fetchrow(self, name: str, *args) -> Optional[asyncpg.Record]:
+        return await self._run("fetchrow", name, args)
+
+    async def fetchval(self, name: str, *args) -> Any:
+        return await self._run("fetchval", name, args)
+
+    async def execute(self, name: str, *args) -> None:
+        await self._run("execute", name, args)
@@ -0,0 +1,203 @@
+import math
+import random
+
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Set, Tuple
+
+
+class _Node():
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key: Any, levels: int):
+        self.key = key
+        self.next = [None] * levels  # type: List[Optional[_Node]]
+        self.width = [1] * levels
+
+
+class IndexableSkiplist():
+    """A sorted collection of unique keys that can also be indexed by position.
+    Every node remembers how many nodes each of its links skips over, so inserting, removing, finding the position
+    of a key and finding the key at a position are all O(log n) on average."""
+
+    MAX_LEVELS = 32
+
+    def __init__(self):
+        self.size = 0
+        self.levels = 1  # the number of levels that any node actually uses
+        self.head = _Node(None, self.MAX_LEVELS)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _chain(self, key: Any) -> Tuple[List[_Node], List[int]]:
+        # the last node before key on every level, and how far along the list each of them is
+        chain = [self.head] * self.MAX_LEVELS
+        positions = [0] * self.MAX_LEVELS
+        node, position = self.head, 0
+        for level in reversed(range(self.levels)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+
+            chain[level], positions[level] = node, position
+
+        return chain, positions
+
+    def insert(self, key: Any) -> None:
+        chain, positions = self._chain(key)
+        levels = min(self.MAX_LEVELS, 1 - int(math.log(1 - random.random(), 2)))
+        for level in range(self.levels, levels):
+            self.head.width[level] = self.size + 1  # the head's links on unused levels skip over everything
+
+        self.levels = max(self.levels, levels)
+        new = _Node(key, levels)
+        for level in range(levels):
+            previous = chain[level]
+            steps = positions[0] - positions[level]  # how far the new node is from the previous node on this level
+            new.next[level], previous.next[level] = previous.next[level], new
+            new.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+
+        for level in range(levels, self.levels):
+            chain[level].width[level] += 1
+
+        self.size += 1
+
+    def remove(self, key: Any) -> None:
+        chain, _ = self._chain(key)
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+
+        for level in range(len(target.next)):
+            chain[level].width[level] += target.width[level] - 1
+            chain[level].next[level] = target.next[level]
+
+        for level in range(len(target.next), self.levels):
+            chain[level].width[level] -= 1
+
+        self.size -= 1
+
+    def index(self, key: Any) -> int:
+        """Returns the number of keys that sort before key."""
+
+        _, positions = self._chain(key)
+        return positions[0]
+
+    def iterate_from(self, start: int) -> Iterator[Any]:
+        if start >= self.size:
+            return
+
+        node, remaining = self.head, start + 1
+        for level in reversed(range(self.levels)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+
+        while node is not None:
+            yield node.key
+            node = node.next[0]
+
+
+class Ranking():
+    """Scores kept in descending order. Ties are broken by ID, so the order is always the same."""
+
+    def __init__(self):
+        self.scores = {}  # type: Dict[int, int]
+        self.order = IndexableSkiplist()
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def __contains__(self, member_id: int) -> bool:
+        return member_id in self.scores
+
+    def set(self, member_id: int, score: int) -> None:
+        if self.scores.get(member_id) == score:
+            return
+
+        self.discard(member_id)
+        self.scores[member_id] = score
+        self.order.insert((-score, member_id))
+
+    def discard(self, member_id: int) -> None:
+        score = self.scores.pop(member_id, None)
+        if score is not None:
+            self.order.remove((-score, member_id))
+
+    def rank(self, member_id: int) -> Optional[int]:
+        """Returns the 1-based position of a member, or None if they aren't ranked."""
+
+        score = self.scores.get(member_id)
+        return None if score is None else self.order.index((-score, member_id)) + 1
+
+    def top(self, count: int, start: int = 0) -> List[Tuple[int, int]]:
+        """Returns up to count (member ID, score) pairs, starting from the given 0-based position."""
+
+        results = []
+        for negative_score, member_id in self.order.iterate_from(start):
+            if len(results) >= count:
+                break
+
+            results.append((member_id, -negative_score))
+
+        return results
+
+
+class Leaderboards():
+    """A global ranking of balances, and a ranking for each guild of the users that have played there.
+    update() should be called whenever a balance changes. reconcile() replaces everything with fresh data from the
+    DB, except for users that were updated while that data was being read - their rankings are already newer."""
+
+    def __init__(self):
+        self.everyone = Ranking()
+        self.guilds = {}  # type: Dict[int, Ranking]
+        self.user_guilds = {}  # type: Dict[int, Set[int]]
+        self.reconciled = False  # until this is set, the rankings only have users whose balances have changed
+        self._updated_while_reconciling = None  # type: Optional[Set[int]]
+
+    def guild(self, guild_id: int) -> Ranking:
+        try:
+            return self.guilds[guild_id]
+        except KeyError:
+            ranking = self.guilds[guild_id] = Ranking()
+            return ranking
+
+    def has_played_in(self, user_id: int, guild_id: int) -> bool:
+        return guild_id in self.user_guilds.get(user_id, ())
+
+    def update(self, user_id: int, balance: int, guild_id: Optional[int] = None) -> None:
+        if guild_id is not None:
+            self.user_guilds.setdefault(user_id, set()).add(guild_id)
+
+        self.everyone.set(user_id, balance)
+        for user_guild_id in self.user_guilds.get(user_id, ()):
+            self.guild(user_guild_id).set(user_id, balance)
+
+        if self._updated_while_reconciling is not None:
+            self._updated_while_reconciling.add(user_id)
+
+    def remove(self, user_id: int) -> None:
+        self.everyone.discard(user_id)
+        for user_guild_id in self.user_guilds.get(user_id, ()):
+            self.guild(user_guild_id).discard(user_id)
+
+    def start_reconciling(self) -> None:
+        self._updated_while_reconciling = set()
+
+    def reconcile(self, balances: Mapping[int, int], memberships: Mapping[int, Set[int]]) -> None:
+        """Brings everything in line with balances (user ID to balance) and memberships (user ID to guild IDs)."""
+
+        skipped, self._updated_while_reconciling = self._updated_while_reconciling or set(), None
+
+        for user_id in list(self.everyone.scores):
+            if user_id not in balances and user_id not in skipped:
+                self.remove(user_id)
+
+        for user_id, guild_ids in memberships.items():
+            self.user_guilds.setdefault(user_id, set()).update(guild_ids)
+
+        for user_id, balance in balances.items():
+            if user_id not in skipped:
+                self.update(user_id, balance)
+
+        self.reconciled = True
@@ -0,0 +1,227 @@
+import logging
+
+from typing import List, Tuple
+
+
+class Migration():
+    """A numbered set of statements that bring the schema up to a version.
+    Statements are run one at a time and the version is only recorded once they have all succeeded,
+    so every statement should be safe to run again if a migration fails partway through."""
+
+    def __init__(self, version: int, description: str, statements: List[str]):
+        self.version = version
+        self.description = description
+        self.statements = statements
+
+
+def _deduplicate(table: str, *columns: str) -> str:
+    # keep the newest row for each key, so that a unique index can be created over it
+    matches = " AND ".join(f"a.{column} = b.{column}" for column in columns)
+    return f"DELETE FROM {table} AS a USING {table} AS b WHERE {matches} AND a._id < b._id"
+
+
+MIGRATIONS = [
+    Migration(1, "baseline tables, unique keys, lookup indexes and the craft function", [
+        # inventory: one row per item with durability, everything else is counted in inventory_stacks
+        """CREATE TABLE IF NOT EXISTS inventory (
+            _id serial PRIMARY KEY,
+            user_id bigint NOT NULL,
+            name text NOT NULL,
+            durability int NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS inventory_stacks (
+            _id serial PRIMARY KEY,
+            user_id bigint NOT NULL,
+            name text NOT NULL,
+            count int NOT NULL,
+            UNIQUE (user_id, name)
+        )""",
+        """CREATE TABLE IF NOT EXISTS channel_locks (
+            _id serial PRIMARY KEY,
+            guild_id bigint NOT NULL,
+            channel_id bigint NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS extended_cooldown (
+            _id serial PRIMARY KEY,
+            unique_id bigint NOT NULL,
+            cooldown_group text NOT NULL,
+            last_accessed timestamptz
+        )""",
+        """CREATE TABLE IF NOT EXISTS action_counts (
+            _id serial PRIMARY KEY,
+            user_id bigint NOT NULL,
+            action text NOT NULL,
+            amount int NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS currency (
+            _id serial PRIMARY KEY,
+            user_id bigint NOT NULL,
+            amount bigint NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS game_time (
+            _id serial PRIMARY KEY,
+            user_id bigint NOT NULL,
+            minutes int NOT NULL
+        )""",
+
+        # last_accessed used to be stored as text - convert it in place if we're looking at an older database
+        """DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'extended_cooldown' AND column_name = 'last_accessed' AND data_type = 'text'
+            ) THEN
+                ALTER TABLE extended_cooldown
+                ALTER COLUMN last_accessed TYPE timestamptz USING last_accessed::timestamptz;
+            END IF;
+        END $$""",
+
+        # items without durability used to get a row each - fold any of those into stacks
+        """WITH moved AS (
+            DELETE FROM inventory WHERE COALESCE(durability, 0) = 0 RETURNING user_id, name
+        )
+        INSERT INTO inventory_stacks (user_id, name, count)
+        SELECT user_id, name, count(*) FROM moved GROUP BY user_id, name
+        ON CONFLICT (user_id, name) DO UPDATE SET count = inventory_stacks.count + EXCLUDED.count""",
+
+        # older databases were created on the fly and can have duplicate rows where there should be one
+        _deduplicate("channel_locks", "guild_id", "channel_id"),
+        _deduplicate("extended_cooldown", "unique_id", "cooldown_group"),
+        _deduplicate("action_counts", "user_id", "action"),
+        _deduplicate("currency", "user_id"),
+        _deduplicate("game_time", "user_id"),
+
+        # every hot lookup is answered from one of these without touching the table
+        "CREATE INDEX IF NOT EXISTS inventory_user_id_name ON inventory (user_id, name) INCLUDE (durability)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS channel_locks_guild_id_channel_id ON channel_locks (guild_id, channel_id)",
+        """CREATE UNIQUE INDEX IF NOT EXISTS extended_cooldown_unique_id_cooldown_group
+        ON extended_cooldown (unique_id, cooldown_group) INCLUDE (last_accessed)""",
+        """CREATE UNIQUE INDEX IF NOT EXISTS action_counts_user_id_action
+        ON action_counts (user_id, action) INCLUDE (amount)""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS currency_user_id ON currency (user_id) INCLUDE (amount)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS game_time_user_id ON game_time (user_id) INCLUDE (minutes)",
+
+        # crafting runs as a single function call so that it's atomic, and costs one round trip
+        # the advisory lock means that two crafts for the same user can never interleave and duplicate items
+        """CREATE OR REPLACE FUNCTION craft_item(
+            p_user_id bigint, p_names text[], p_amounts int[], p_workbench text,
+            p_product text, p_makes int, p_durability int, p_minutes int,
+            p_starting_time int, p_day_length int
+        ) RETURNS TABLE (crafted boolean, has_workbench boolean, owned int[], current_minutes int) AS $fn$
+        DECLARE
+            v_from_stack int;
+            i int;
+        BEGIN
+            PERFORM pg_advisory_xact_lock(p_user_id);
+
+            SELECT array_agg(
+                COALESCE((
+                    SELECT s.count FROM inventory_stacks AS s WHERE s.user_id = p_user_id AND s.name = n.name
+                ), 0) + (
+                    SELECT count(*) FROM inventory AS inv WHERE inv.user_id = p_user_id AND inv.name = n.name
+                )::int
+                ORDER BY n.ord
+            ) INTO owned
+            FROM unnest(p_names) WITH ORDINALITY AS n (name, ord);
+
+            has_workbench := p_workbench IS NULL OR EXISTS (
+                SELECT 1 FROM inventory_stacks AS s
+                WHERE s.user_id = p_user_id AND s.name = p_workbench AND s.count > 0
+            ) OR EXISTS (
+                SELECT 1 FROM inventory AS inv WHERE inv.user_id = p_user_id AND inv.name = p_workbench
+            );
+
+            crafted := has_workbench;
+            FOR i IN 1 .. coalesce(array_length(p_names, 1), 0) LOOP
+                crafted := crafted AND owned[i] >= p_amounts[i];
+            END LOOP;
+
+            IF NOT crafted THEN
+                RETURN NEXT;
+                RETURN;
+            END IF;
+
+            -- take ingredients from stacks first, then from individual items
+            FOR i IN 1 .. coalesce(array_length(p_names, 1), 0) LOOP
+                SELECT LEAST(COALESCE((
+                    SELECT s.count FROM inventory_stacks AS s WHERE s.user_id = p_user_id AND s.name = p_names[i]
+                ), 0), p_amounts[i]) INTO v_from_stack;
+
+                UPDATE inventory_stacks AS s SET count = s.count - v_from_stack
+                WHERE s.user_id = p_user_id AND s.name = p_names[i];
+
+                DELETE FROM inventory WHERE _id IN (
+                    SELECT inv._id FROM inventory AS inv
+                    WHERE inv.user_id = p_user_id AND inv.name = p_names[i]
+                    LIMIT p_amounts[i] - v_from_stack
+                );
+            END LOOP;
+
+            IF p_durability = 0 THEN
+                INSERT INTO inventory_stacks (user_id, name, count) VALUES (p_user_id, p_product, p_makes)
+                ON CONFLICT (user_id, name) DO UPDATE SET count = inventory_stacks.count + EXCLUDED.count;
+            ELSE
+                INSERT INTO inventory (user_id, name, durability)
+                SELECT p_user_id, p_product, p_durability FROM generate_series(1, p_makes);
+            END IF;
+
+            UPDATE game_time AS g
+            SET minutes = ((g.minutes + p_minutes) % p_day_length + p_day_length) % p_day_length
+            WHERE g.user_id = p_user_id RETURNING g.minutes INTO current_minutes;
+
+            IF NOT FOUND THEN
+                current_minutes := ((p_starting_time + p_minutes) % p_day_length + p_day_length) % p_day_length;
+                INSERT INTO game_time (user_id, minutes) VALUES (p_user_id, current_minutes);
+            END IF;
+
+            RETURN NEXT;
+        END
+        $fn$ LANGUAGE plpgsql"""
+    ]),
+    Migration(2, "guilds that users have used currency in, for per-guild leaderboards", [
+        """CREATE TABLE IF NOT EXISTS currency_guilds (
+            user_id bigint NOT NULL,
+            guild_id bigint NOT NULL,
+            PRIMARY KEY (user_id, guild_id)
+        )"""
+    ]),
+    Migration(3, "weapon strengths, mirrored from items.toml", [
+        """CREATE TABLE IF NOT EXISTS weapon_strength (
+            name text PRIMARY KEY,
+            strength int NOT NULL
+        )"""
+    ])
+]
+
+
+async def migrate(db, logger: logging.Logger, migrations: List[Migration] = MIGRATIONS) -> Tuple[int, int]:
+    """Applies every migration newer than the version recorded in the database, in order.
+    Returns the versions that the database was at before and after."""
+
+    await db.execute_query(
+        """CREATE TABLE IF NOT EXISTS schema_version (
+            version int PRIMARY KEY,
+            description text NOT NULL,
+            applied_at timestamptz NOT NULL DEFAULT now()
+        )"""
+    )
+
+    results = await db.fetch_query("SELECT COALESCE(max(version), 0) AS version FROM schema_version")
+    starting_version = current_version = results[0]["version"]
+
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version <= current_version:
+            continue
+
+        logger.info("Migrating database schema to version %s: %s", migration.version, migration.description)
+        for statement in migration.statements:
+            await db.execute_query(statement)
+
+        await db.execute_query(
+            "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+            migration.version, migration.description
+        )
+
+        current_version = migration.version
+
+    return starting_version, current_version
@@ -1,12 +1,9 @@
-import os
-
 from concurrent.futures import ThreadPoolExecutor
 
 import pendulum
 import discord
 import click
 import toml
-import markovify
 
 from extensions.models import botclasses
 from discord.ext import commands
@@ -58,29 +55,6 @@ def run(**kwargs):
         else:
             bot.logger.info("Extension %s loaded successfully.", extension)
 
-    if config["markov"]["use_markov"]:
-        # check if we have a frozen model available
-        if os.path.isfile(config["markov"]["filepath"] + ".generated"):
-            bot.logger.info("Pre-generated model found! Loading...")
-            with open(config["markov"]["filepath"] + ".generated", "r", encoding="utf-8", errors="ignore") as f:
-                bot._markov_model = markovify.NewlineText.from_json(f.read())
-
-            bot.logger.info("Model loaded.")
-        else:
-            # no frozen model, generate
-            bot.logger.info("Generating markov model! This may take a while.")
-            with open(config["markov"]["filepath"], "r", encoding="utf-8", errors="ignore") as f:
-                bot._markov_model = markovify.NewlineText(f, retain_original=False, state_size=2)
-
-            bot._markov_model.compile(inplace=True)
-            bot.logger.info("Model generated.")
-            with open(config["markov"]["filepath"] + ".generated", "w+", encoding="utf-8", errors="ignore") as f:
-                f.write(bot._markov_model.to_json())
-
-            bot.logger.info("Saved generated model for future usage.")
-    else:
-        bot._markov_model = None
-
     bot.allowed_mentions = discord.AllowedMentions(everyone=False, users=False, roles=False)
     bot.run(token)
 